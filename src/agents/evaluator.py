@@ -1,7 +1,7 @@
 from kani import Kani
-from kani.models import ChatMessage, ChatRole
-from kani.exceptions import MessageTooLong
+from kani.models import ChatMessage
 from copy import deepcopy
+from token_lengths import TokenLengthCache, PrefixTokenLengths
 from constants import RULE_SUMMARY
 
 import logging
@@ -17,6 +17,10 @@ class Evaluator(Kani):
 
         rule_content = '\n'.join([' '.join(part) for part in RULE_SUMMARY])
         self.rule_prompt = ChatMessage.system(name="Game_Rules", content=rule_content)
+
+        # The memoized token lengths of the messages and the prefix sums of the chat history.
+        self.token_lens = TokenLengthCache(super().message_token_len)
+        self.history_lens = PrefixTokenLengths(self.message_token_len)
     
     # Overriding get_prompt.
     async def get_prompt(self) -> list[ChatMessage]:
@@ -32,30 +36,9 @@ class Evaluator(Kani):
         """
         always_len = self.always_len
         rule_prompt_len = self.message_token_len(self.rule_prompt)
-        remaining = max_size = self.max_context_size - always_len - rule_prompt_len
-        total_tokens = 0
-        to_keep = 0  # messages to keep from the end of chat history
-        for message in reversed(self.chat_history):
-            # get and check the message's length
-            message_len = self.message_token_len(message)
-            if message_len > max_size:
-                func_help = (
-                    ""
-                    if message.role != ChatRole.FUNCTION
-                    else "You may set `auto_truncate` in the @ai_function to automatically truncate long responses.\n"
-                )
-                raise MessageTooLong(
-                    "The chat message's size is longer than the allowed context window (after including system"
-                    " messages, always included messages, and desired response tokens).\n"
-                    f"{func_help}Content: {message.text[:100]}..."
-                )
-            # see if we can include it
-            remaining -= message_len
-            if remaining >= 0:
-                total_tokens += message_len
-                to_keep += 1
-            else:
-                break
+        max_size = self.max_context_size - always_len - rule_prompt_len
+        self.history_lens.sync(self.chat_history)
+        to_keep, total_tokens = self.history_lens.truncate(max_size)  # Binary search on the prefix sums of the token lengths.
         log.debug(
             f"get_prompt() returned {always_len + total_tokens} tokens ({always_len} always) in"
             f" {len(self.always_included_messages) + to_keep} messages"
@@ -67,3 +50,7 @@ class Evaluator(Kani):
         if not to_keep:
             return default_prompt
         return default_prompt + self.chat_history[-to_keep:]
+
+    # Overriding message_token_len to look up the memoized lengths by the message identity first.
+    def message_token_len(self, message: ChatMessage):
+        return self.token_lens(message)
@@ -1,22 +1,31 @@
 from kani import Kani, ai_function, AIParam
 from kani.models import ChatMessage, ChatRole, FunctionCall, ToolCall
-from kani.exceptions import FunctionCallException, MessageTooLong, NoSuchFunction, WrappedCallException
+from kani.exceptions import FunctionCallException, NoSuchFunction, WrappedCallException
 from kani.internal import FunctionCallResult, ExceptionHandleResult
 from kani.utils.message_formatters import assistant_message_contents
 from kani.engines.base import BaseCompletion
 from agents.player import Player, PlayerKani
+from gameplay_logs import DeltaLogEncoder
+from embeddings import EmbeddingCache, get_encoder, load_rule_embeddings
+from retrieval import BM25Index, build_index, max_pooled_top_k, reciprocal_rank_fusion
+from token_lengths import TokenLengthCache, PrefixTokenLengths
+from state_patch import StateUpdateError, apply_state_patch
 from constants import (
     SEP,
+    SENTENCE_ENCODER,
     RULE_SUMMARY,
     STATE_DETECT_PROMPT,
+    STATE_BATCH_DETECT_PROMPT,
     STATE_UPDATE_PROMPT,
+    STATE_PATCH_PROMPT,
     VALIDATE_SUCCESS_PROMPT, 
     VALIDATE_FAILURE_PROMPT,
     DIFFICULTY_PROMPT,
     CREATE_NPC_PROMPT,
     TABLE_PROCESSING_PROMPT,
     EXPENDABLE_CHECK_PROMPT, 
-    SUMMARIZE_PROMPT
+    SUMMARIZE_PROMPT,
+    FOLD_SUMMARY_PROMPT
 )
 from utils import (
     print_system_log, 
@@ -26,17 +35,14 @@ from utils import (
     convert_into_number, 
     convert_into_class_idx
 )
-from typing import AsyncIterable, Annotated, Tuple, Callable
+from typing import AsyncIterable, Annotated, Awaitable, Tuple, Callable
 from argparse import Namespace
 from copy import deepcopy
 from itertools import chain
-from sentence_transformers import SentenceTransformer, util
 
 import json
 import logging
 import random
-import numpy as np
-import torch
 import asyncio
 
 log = logging.getLogger("kani")
@@ -59,41 +65,71 @@ class GameManager(Kani):
         self.environment = scene['environment']
         self.random_tables = scene['random_tables']
         self.consequences = scene['consequences']
+        self.scene_version = 0  # Increased whenever the scene state is changed, so the cached scene prompt is reused until then.
+        self.field_versions = {}  # field => The scene version when the field was changed last time.
 
         # Additional arguments for prompt design policy.
         self.concat_policy = main_args.concat_policy
         self.max_num_msgs = main_args.max_num_msgs
         self.summarization = True if main_args.summarization else False
         self.summ_period = main_args.summ_period
+        self.summ_budget = main_args.summ_budget
         self.clear_raw_logs = True if main_args.clear_raw_logs else False
+        self.async_summarization = True if main_args.async_summarization else False
+        self.summ_merge_size = main_args.summ_merge_size
+        self.rule_injection = main_args.rule_injection
+        self.validation_policy = main_args.validation_policy
+        self.state_detection = main_args.state_detection
+        self.state_update_protocol = main_args.state_update_protocol
+        self.validation_window = main_args.validation_window
 
         # Additional attributes for enabling the prompt policies.
         self.encoder = None
-        if main_args.concat_policy == 'retrieval' or main_args.rule_injection == 'retrieval':
-            device = torch.device('cuda:0') if torch.cuda.is_available() else torch.device('cpu')
-            self.encoder = SentenceTransformer('all-mpnet-base-v2').to(device)
-        self.sent_embs = np.empty((0, self.encoder.get_sentence_embedding_dimension())) if self.concat_policy == 'retrieval' else None
+        self.embedding_cache = None
+        if main_args.concat_policy == 'retrieval' or main_args.rule_injection in ['retrieval', 'hybrid'] or main_args.validation_policy == 'retrieval':
+            self.encoder = get_encoder(SENTENCE_ENCODER, main_args.encoder_backend, main_args.encoder_threads)  # The model is shared with other managers and loaded on the first use.
+            self.embedding_cache = EmbeddingCache(self.encoder)  # Shared by the history retrieval, rule retrieval, and history embeddings.
+        self.embedding_precision = main_args.embedding_precision
+        self.sent_embs = build_index(main_args.retrieval_index, self.embedding_precision, main_args.ann_threshold) if self.concat_policy == 'retrieval' else None
+        self.token_lens = TokenLengthCache(super().message_token_len)  # The memoized token lengths of the messages.
+        self.history_lens = PrefixTokenLengths(self.message_token_len)  # The prefix sums of the token lengths in the chat history.
         self.current_queries = []
         self.raw_history = []
         self.start_idx = 0
         self.turn_count = 0
         self.retrieved_messages = None
         self.retrieved_rules = None
+        self.scene_prompt = None  # (version, prompt) of the last scene prompt.
+        self.snapshots = {}  # key => (version, copy) of the scene and its fields, which are shared by the contexts until they are changed.
+        self.rolling_summary = None  # The cached summary when summarization is used without any period.
+        self.num_summarized = 0  # The number of messages in the chat history which have been folded into the rolling summary.
+        self.summary_task = None  # (start, end, task) of the summarization running in the background.
+        self.summary_levels = []  # (summary, level) of the summaries in the chat history in chronological order.
+        self.last_validation = None  # ((number of raw messages, last raw message, conditions), (success, failure)) of the last validation.
+        self.validation_lock = asyncio.Lock()  # The success and failure validations share the states below.
+        self.validation_embs = build_index('exact', self.embedding_precision) if self.validation_policy == 'retrieval' else None  # The embeddings of the raw history before the window.
+        self.validation_summary = None  # The summary of the raw history before the window.
+        self.num_validation_summarized = 0
 
         # Additional attributes for game play.
         self.players = []
         self.name_to_idx = {}
         self.is_action_scene = False
         self.gameplay_logs = []
+        self.log_encoder = DeltaLogEncoder() if main_args.log_format == 'delta' else None
 
-        # Pre-buidling the rule prompt or embeddings.
+        # Pre-buidling the rule prompt, embeddings, or lexical index.
         self.game_rules = []
         self.rule_embs = None
-        if main_args.rule_injection == 'retrieval':
+        self.rule_index = None
+        if main_args.rule_injection != 'full':
             self.game_rules = list(chain.from_iterable(RULE_SUMMARY))
-            self.rule_embs = self.encoder.encode(self.game_rules).astype('float64')
+        if main_args.rule_injection in ['retrieval', 'hybrid']:
+            self.rule_embs = load_rule_embeddings(self.game_rules, self.encoder.key, self.embedding_precision, self.encoder.encode, main_args.embedding_cache_dir)
 
-            assert self.rule_embs.shape[0] == len(self.game_rules), "The number of rule embeddings should be identical to the length of rule list."
+            assert len(self.rule_embs) == len(self.game_rules), "The number of rule embeddings should be identical to the length of rule list."
+        if main_args.rule_injection in ['lexical', 'hybrid']:
+            self.rule_index = BM25Index(self.game_rules)  # No sentence encoder is needed for the lexical scores.
 
     # Setting the attributes in the scene.
     def set_scene(self, obj):
@@ -107,6 +143,7 @@ class GameManager(Kani):
         self.environment = obj['environment']
         self.random_tables = obj['random_tables']
         self.consequences = obj['consequences']
+        self.mark_scene_changed('scene_summary', 'npcs', 'game_flow', 'environment', 'random_tables')
 
     # Setting the attributes in a player.
     def set_player(self, player: Player, obj: dict):
@@ -118,6 +155,13 @@ class GameManager(Kani):
         player.flaws = obj['flaws']
         player.inventory = obj['inventory']
         player.additional_notes = obj['additional_notes']
+        player.state_version += 1
+
+    # Marking the scene as changed. The fields are the mutable ones which have been changed.
+    def mark_scene_changed(self, *fields):
+        self.scene_version += 1
+        for field in fields:
+            self.field_versions[field] = self.scene_version
 
     # Getter for NPC in a natural format.
     def get_npc(self, info):
@@ -188,9 +232,10 @@ class GameManager(Kani):
         print(self.consequences)
 
     # Encoding the chat messages into the sentence embedding vectors.
-    def encode_messages(self, messages: list[ChatMessage]):
+    # The encoding runs on the worker thread, so the other coroutines are not blocked.
+    async def encode_messages(self, messages: list[ChatMessage]):
         contents = [convert_into_natural(message) for message in messages]
-        return self.encoder.encode(contents).astype('float64')  # (N, d)
+        return await self.embedding_cache.encode_async(contents)  # (N, d)
 
     # Overriding add_to_history.
     async def add_to_history(self, messages: list[ChatMessage], store_in_raw: bool=True):
@@ -200,41 +245,138 @@ class GameManager(Kani):
 
         # Sentence embedding for the retrieval.
         if self.sent_embs is not None:
-            embs = self.encode_messages(messages)  # (N, d)
-            self.sent_embs = np.concatenate((self.sent_embs, embs))
+            embs = await self.encode_messages(messages)  # (N, d)
+            self.sent_embs.append(embs)
 
             # The number of sentence embeddings and chat logs should always be identical.
-            assert len(self.chat_history) == self.sent_embs.shape[0], "The sentence embeddings and chat histories are not synced."
+            assert len(self.chat_history) == len(self.sent_embs), "The sentence embeddings and chat histories are not synced."
+
+    # Adding the summary of chat_history[start:end] right after the summarized messages.
+    # If clear_raw_logs=True, the summarized messages are replaced with the summary.
+    async def add_summary(self, start: int, end: int, summary: ChatMessage, merges: list=None):
+        if self.clear_raw_logs:
+            self.chat_history = self.chat_history[:start] + [summary] + self.chat_history[end:]
+            if self.sent_embs is not None:
+                self.sent_embs.delete(start, end)
+                self.sent_embs.insert(start, await self.encode_messages([summary]))  # Compacting in place except for the summary.
+            shift = 1 - (end - start)
+        else:
+            self.chat_history = self.chat_history[:end] + [summary] + self.chat_history[end:]
+            if self.sent_embs is not None:
+                self.sent_embs.insert(end, await self.encode_messages([summary]))
+            shift = 1
+
+        # The messages after the summarized ones, which have not been summarized yet, are shifted.
+        if self.start_idx >= end:
+            self.start_idx += shift
+        self.summary_levels.append((summary, 0))
+
+        # Replacing the merged summaries with the higher-level summary, which is placed where the last child was.
+        for merged, level, children in (merges if merges is not None else []):
+            idxs = [next(i for i, message in enumerate(self.chat_history) if message is child) for child in children]
+            for idx in sorted(idxs, reverse=True):
+                del self.chat_history[idx]
+                if self.sent_embs is not None:
+                    self.sent_embs.delete(idx, idx+1)
+            idx = max(idxs) - (len(idxs) - 1)
+            self.chat_history.insert(idx, merged)
+            if self.sent_embs is not None:
+                self.sent_embs.insert(idx, await self.encode_messages([merged]))
+
+            self.start_idx -= len(idxs) - 1  # All summaries are before start_idx.
+            self.summary_levels = [(message, l) for message, l in self.summary_levels if not any(message is child for child in children)]
+            self.summary_levels.append((merged, level))
+
+        if self.sent_embs is not None:
+            assert len(self.chat_history) == len(self.sent_embs), "The sentence embeddings and chat histories are not synced."
+
+    # Checking if the chat logs which have not been summarized yet should be summarized now.
+    def should_summarize(self) -> bool:
+        if self.summ_period is not None and self.turn_count == self.summ_period:
+            return True
+        if self.summ_budget is not None:  # The fraction of the context window used by the logs since the last summarization.
+            self.history_lens.sync(self.chat_history)
+            num_tokens = self.history_lens.sums[-1] - self.history_lens.sums[self.start_idx]
+            return num_tokens >= self.summ_budget * self.max_context_size
+        return False
+
+    # Summarizing the chat logs. If summ_merge_size is set, the summaries in the same level are merged level by level.
+    # This does not change the chat history, so it can run in the background.
+    async def make_summaries(self, input_history: list[ChatMessage]) -> Tuple[ChatMessage, list]:
+        summary = await self.summarize_history(input_history)
+        if self.summ_merge_size is None:
+            return summary, []
+
+        merges = []  # (merged summary, level, children)
+        summary_levels = list(self.summary_levels)
+        current, level = summary, 0
+        while True:
+            # There are at most (summ_merge_size - 1) summaries in each level, so this is bounded by the number of levels.
+            children = [message for message, l in summary_levels if l == level] + [current]
+            if len(children) < self.summ_merge_size:
+                break
+
+            current = await self.summarize_history(list(children))  # The children should be the summaries in the chat history only.
+            merges.append((current, level+1, children))
+            summary_levels = [(message, l) for message, l in summary_levels if l != level]
+            level += 1
+
+        return summary, merges
+
+    # Adding the summary from the background summarization if it has been finished.
+    async def splice_summary(self, wait: bool=False):
+        if self.summary_task is None:
+            return
+        start, end, task = self.summary_task
+        if not wait and not task.done():
+            return
+
+        summary, merges = await task
+        self.summary_task = None
+        await self.add_summary(start, end, summary, merges)
+
+    # Logging the failure of the background summarization as soon as it happens.
+    # The error is raised again when the summary is spliced.
+    @staticmethod
+    def log_summary_failure(task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            log.error(f"The background summarization has failed: {task.exception()!r}")
+
+    # Finishing the background jobs before the event loop is closed.
+    # The pending summary is added so that the final chat history is complete.
+    async def finish(self):
+        if self.summary_task is None:
+            return
+        try:
+            await self.splice_summary(wait=True)
+        except Exception:  # Already logged by log_summary_failure.
+            log.warning("The last summary has not been added since the background summarization has failed.")
+            self.summary_task = None
 
     # Making a prompt using the simple concatenation.
     def get_simple_history(self) -> list[ChatMessage]:
-        valid_chat_history = self.chat_history + self.current_queries
-        if self.max_num_msgs is None:
-            return valid_chat_history
-        else:
-            if len(self.current_queries) > self.max_num_msgs:
-                return deepcopy(self.current_queries)
+        return self.chat_history[self.get_simple_start():] + self.current_queries
 
-            valid_chat_history = valid_chat_history[max(len(valid_chat_history)-self.max_num_msgs, 0):]
-
-        return valid_chat_history
+    # Getting the start index of the chat history in the simple concatenation. The current queries are always included after it.
+    def get_simple_start(self) -> int:
+        if self.max_num_msgs is None:
+            return 0
+        return max(len(self.chat_history) - max(self.max_num_msgs - len(self.current_queries), 0), 0)
 
     # Making a prompt using the retrieval concatenation.
-    def get_retrieval_history(self) -> list[ChatMessage]:
+    async def get_retrieval_history(self) -> list[ChatMessage]:
         # If this is the case, retrieval has no meaning.
         if len(self.chat_history) + len(self.current_queries) <= self.max_num_msgs or self.max_num_msgs <= len(self.current_queries):
             return self.get_simple_history()
         
-        # Calculating the max-pooled cosine similarities.
+        # Calculating the max-pooled cosine similarities of the candidates from the index.
         top_n = self.max_num_msgs - len(self.current_queries)
-        query_embs, cand_embs = self.encode_messages(self.current_queries), self.sent_embs  # (Q, d), (C, d)
-        cos_sims = util.cos_sim(query_embs, cand_embs)  # (Q, C)
-        scores = torch.max(cos_sims, dim=0).values  # (C)
-
-        # Sorting the candidate logs by the similarities.
-        idxs = torch.sort(scores, descending=True).indices[:top_n]
-        idxs = torch.sort(idxs).values
-        retrieved, scores = [self.chat_history[idx] for idx in idxs], [scores[idx].item() for idx in idxs]
+        query_embs = await self.encode_messages(self.current_queries)  # (Q, d)
+        candidates, scores = self.sent_embs.search(query_embs, min_candidates=top_n)  # (C), (C)
+
+        # Selecting the top candidate logs. The candidates are in ascending order, so this keeps the chronological order.
+        idxs, scores = max_pooled_top_k(scores, top_n)
+        retrieved, scores = [self.chat_history[candidates[idx]] for idx in idxs], scores.tolist()
         valid_chat_history = retrieved + self.current_queries
 
         # Checking the length of the valid chat logs.
@@ -248,11 +390,12 @@ class GameManager(Kani):
         return valid_chat_history
 
     # Summarizing the given dialogue history.
-    async def summarize_history(self, input_history: list[ChatMessage]) -> ChatMessage:
+    # fold=True: The history may start with a previous summary, which should be covered by the new summary.
+    async def summarize_history(self, input_history: list[ChatMessage], fold: bool=False) -> ChatMessage:
         # The default system prompt for the instruction.
-        system_prompt = ' '.join(SUMMARIZE_PROMPT)
+        system_prompt = ' '.join(FOLD_SUMMARY_PROMPT if fold else SUMMARIZE_PROMPT)
         
-        kani = Kani(self.engine, chat_history=input_history, system_prompt=system_prompt)
+        kani = Kani(self.engine, chat_history=list(input_history), system_prompt=system_prompt)  # Kani appends the query and reply to the given list.
         generation_params = {
             'temperature': 0.5,
             'top_p': 1,
@@ -263,6 +406,20 @@ class GameManager(Kani):
 
         return ChatMessage.system(content=res, name="Summary")
 
+    # Getting the rolling summary of the whole chat history.
+    # Only the messages added since the last summary are folded into the previous summary.
+    async def get_rolling_summary(self) -> ChatMessage:
+        if self.num_summarized > len(self.chat_history):  # The chat history has been reset.
+            self.rolling_summary, self.num_summarized = None, 0
+
+        new_messages = self.chat_history[self.num_summarized:]
+        if len(new_messages) > 0:
+            input_history = ([self.rolling_summary] if self.rolling_summary is not None else []) + new_messages
+            self.rolling_summary = await self.summarize_history(input_history, fold=True)
+            self.num_summarized = len(self.chat_history)
+
+        return self.rolling_summary
+
     # Overriding get_prompt.
     async def get_prompt(self,
         include_rules: bool = True,
@@ -270,19 +427,20 @@ class GameManager(Kani):
         include_player_states: bool = True,
     ) -> list[ChatMessage]:
         # First, setting the additional information.
-        default_prompt = deepcopy(self.always_included_messages)
+        # The messages are immutable, so they are shared by reference instead of being copied.
+        default_prompt = list(self.always_included_messages)
 
         rule_prompt_len = 0
         if include_rules:
-            rule_prompt = self.make_rule_prompt()
+            rule_prompt = await self.make_rule_prompt()
             rule_prompt_len = self.message_token_len(rule_prompt)
-            default_prompt.append(deepcopy(rule_prompt))
+            default_prompt.append(rule_prompt)
 
         scene_prompt_len = 0
         if include_scene_state:
             scene_prompt = self.make_scene_prompt()
             scene_prompt_len = self.message_token_len(scene_prompt)
-            default_prompt.append(deepcopy(scene_prompt))
+            default_prompt.append(scene_prompt)
         
         player_prompts_len = 0
         if include_player_states:
@@ -293,40 +451,23 @@ class GameManager(Kani):
 
         always_len = self.always_len + rule_prompt_len + scene_prompt_len + player_prompts_len  # Additional length for rule/scene information.
 
+        # The valid chat history is chat_history[start:] + tail, so the chat history is not copied before the truncation.
         # If summarization + no period, valid_chat_history is just one summary and the current query.
-        if self.summarization and self.summ_period is None:
-            summary = await self.summarize_history(self.chat_history)
-            valid_chat_history = [summary] + self.current_queries
+        # The chat history is not changed during a turn, so the same summary is reused across the function calls.
+        start, tail = len(self.chat_history), []
+        if self.summarization and self.summ_period is None and self.summ_budget is None:
+            summary = await self.get_rolling_summary()
+            tail = ([summary] if summary is not None else []) + self.current_queries
         else:
             if self.concat_policy == 'simple':
-                valid_chat_history = self.get_simple_history()
+                start, tail = self.get_simple_start(), self.current_queries
             elif self.concat_policy == 'retrieval':
-                valid_chat_history = self.get_retrieval_history()
-
-        remaining = max_size = self.max_context_size - always_len
-        total_tokens = 0
-        to_keep = 0  # messages to keep from the end of chat history
-        for message in reversed(valid_chat_history):
-            # get and check the message's length
-            message_len = self.message_token_len(message)
-            if message_len > max_size:
-                func_help = (
-                    ""
-                    if message.role != ChatRole.FUNCTION
-                    else "You may set `auto_truncate` in the @ai_function to automatically truncate long responses.\n"
-                )
-                raise MessageTooLong(
-                    "The chat message's size is longer than the allowed context window (after including system"
-                    " messages, always included messages, and desired response tokens).\n"
-                    f"{func_help}Content: {message.content[:100]}..."
-                )
-            # see if we can include it
-            remaining -= message_len
-            if remaining >= 0:
-                total_tokens += message_len
-                to_keep += 1
-            else:
-                break
+                tail = await self.get_retrieval_history()
+
+        # Finding the messages to keep from the end with the prefix sums of the token lengths.
+        max_size = self.max_context_size - always_len
+        self.history_lens.sync(self.chat_history)
+        to_keep, total_tokens = self.history_lens.truncate(max_size, start, tail)
         log.debug(
             f"get_prompt() returned {always_len + total_tokens} tokens ({always_len} always) in"
             f" {len(self.always_included_messages) + to_keep} messages"
@@ -335,27 +476,42 @@ class GameManager(Kani):
 
         if not to_keep:
             return default_prompt
-        prompt = default_prompt + valid_chat_history[-to_keep:]
+        if to_keep > len(tail):
+            prompt = default_prompt + self.chat_history[len(self.chat_history)-(to_keep-len(tail)):] + tail
+        else:
+            prompt = default_prompt + tail[len(tail)-to_keep:]
 
         return prompt
 
+    # Overriding message_token_len to look up the memoized lengths by the message identity first.
+    def message_token_len(self, message: ChatMessage):
+        return self.token_lens(message)
+
     # Making the rule prompt.
-    def make_rule_prompt(self, top_n: int=5):
-        if self.rule_embs is not None:  # This means the manager using the retrieval-based rules.
-            # Calculating the cosine similarities between the queries and rules.
-            query_embs = self.encode_messages(self.current_queries)  # (Q, d)
-            cos_sims = util.cos_sim(query_embs, self.rule_embs)  # (Q, C)
-            scores = torch.max(cos_sims, dim=0).values  # (C)
-
-            # Sorting the candidate logs by the similarities.
-            idxs = torch.sort(scores, descending=True).indices[:top_n]
-            idxs = torch.sort(idxs).values
-            valid_rules, scores = [self.game_rules[idx] for idx in idxs], [scores[idx].item() for idx in idxs]
+    async def make_rule_prompt(self, top_n: int=5):
+        if self.rule_injection != 'full':  # This means the manager using the retrieval-based rules.
+            # Calculating the max-pooled cosine similarities and/or BM25 scores between the queries and rules.
+            if self.rule_embs is not None:
+                query_embs = await self.encode_messages(self.current_queries)  # (Q, d)
+                dense_scores = self.rule_embs.similarity(query_embs).max(axis=0)  # (C)
+            if self.rule_index is not None:
+                lexical_scores = self.rule_index.score([convert_into_natural(message) for message in self.current_queries]).max(axis=0)  # (C)
+
+            if self.rule_injection == 'hybrid':
+                scores = reciprocal_rank_fusion([dense_scores, lexical_scores])
+            elif self.rule_injection == 'lexical':
+                scores = lexical_scores
+            else:
+                scores = dense_scores
+
+            # Selecting the top rules by the scores.
+            idxs, scores = max_pooled_top_k(scores, top_n)
+            valid_rules, scores = [self.game_rules[idx] for idx in idxs], scores.tolist()
 
             assert len(valid_rules) == top_n, "The number of retrieved rules is not same as the pre-defined top_n."
             assert len(valid_rules) == len(scores), "The retrieved rules are not matched with the calculated scores."
 
-            # Since this function only works when rule_injection=retrieval, the retrieved rules are also exported.
+            # Since this function only works when the rules are retrieved, the retrieved rules are also exported.
             self.retrieved_rules = list(zip(valid_rules, scores))
 
             rule_content = '\n'.join(valid_rules)
@@ -366,21 +522,29 @@ class GameManager(Kani):
         rule_prompt = ChatMessage.system(name="Game_Rules", content=rule_content)
         return rule_prompt
 
-    # Making the scene prompt.
+    # Making the scene prompt. The previous one is reused if the scene state has not been changed since then.
     def make_scene_prompt(self):
+        if self.scene_prompt is not None and self.scene_prompt[0] == self.scene_version:
+            return self.scene_prompt[1]
+
         content = f"chapter={self.chapter}, scene={self.scene}, scene_summary={self.scene_summary}, " + \
             f"npcs={self.npcs}, success_condition={self.success_condition}, failure_condition={self.failure_condition}, " + \
             f"game_flow={self.game_flow}, environment={self.environment}, random_tables={self.random_tables}, consequences={self.consequences}, " + \
             f"is_action_scene={self.is_action_scene}"
         
         scene_prompt = ChatMessage.system(name="Scene_State", content=content)
+        self.scene_prompt = (self.scene_version, scene_prompt)
         return scene_prompt
 
-    # Making one player prompt.
+    # Making one player prompt. The previous one is reused if the player state has not been changed since then.
     def make_player_prompt(self, player: Player):
+        if player.state_prompt is not None and player.state_prompt[0] == player.state_version:
+            return player.state_prompt[1]
+
         content = f"name={player.name}, kin={player.kin}, persona={player.persona}, goal={player.goal}, " + \
             f"traits={player.traits}, flaws={player.flaws}, inventory={player.inventory}, additional_notes={player.additional_notes}"
         player_prompt = ChatMessage.system(name="Player_State", content=content)
+        player.state_prompt = (player.state_version, player_prompt)
         return player_prompt
 
     # Making the player prompts.
@@ -391,35 +555,48 @@ class GameManager(Kani):
 
         return player_prompts
 
+    # Getting the copy of a state. The previous copy is shared until the version is changed.
+    def get_snapshot(self, key, version: int, make_fn):
+        if key not in self.snapshots or self.snapshots[key][0] != version:
+            self.snapshots[key] = (version, make_fn())
+        return self.snapshots[key][1]
+
+    # Getting the copy of a mutable scene field.
+    def get_field_snapshot(self, field: str):
+        return self.get_snapshot(field, self.field_versions.get(field, 0), lambda: deepcopy(getattr(self, field)))
+
     # Making the context for exporting data.
+    # The unchanged scene, fields, and players share the copies in the previous contexts, so they should not be modified.
     def make_context(self):
         context = {
-            "scene": {
+            "scene": self.get_snapshot('scene', self.scene_version, lambda: {
                 "chapter": self.chapter,
                 "scene": self.scene,
-                "scene_summary": deepcopy(self.scene_summary),
-                "npcs": deepcopy(self.npcs),
+                "scene_summary": self.get_field_snapshot('scene_summary'),
+                "npcs": self.get_field_snapshot('npcs'),
                 "success_condition": self.success_condition,
                 "failure_condition": self.failure_condition,
-                "game_flow": deepcopy(self.game_flow),
-                "environment": deepcopy(self.environment),
-                "random_tables": deepcopy(self.random_tables),
+                "game_flow": self.get_field_snapshot('game_flow'),
+                "environment": self.get_field_snapshot('environment'),
+                "random_tables": self.get_field_snapshot('random_tables'),
                 "consequences": self.consequences,
                 "is_action_scene": self.is_action_scene
-            },
+            }),
         }
         players = []
         for player in self.players:
-            players.append({
-                "name": player.name,
-                "kin": player.kin,
-                "persona": deepcopy(player.persona),
-                "goal": player.goal,
-                "traits": deepcopy(player.traits),
-                "flaws": deepcopy(player.flaws),
-                "inventory": deepcopy(player.inventory),
-                "additional_notes": deepcopy(player.additional_notes)
-            })
+            if player.state_snapshot is None or player.state_snapshot[0] != player.state_version:  # The copy is kept in the player object.
+                player.state_snapshot = (player.state_version, {
+                    "name": player.name,
+                    "kin": player.kin,
+                    "persona": deepcopy(player.persona),
+                    "goal": player.goal,
+                    "traits": deepcopy(player.traits),
+                    "flaws": deepcopy(player.flaws),
+                    "inventory": deepcopy(player.inventory),
+                    "additional_notes": deepcopy(player.additional_notes)
+                })
+            players.append(player.state_snapshot[1])
         context["players"] = players
 
         return context
@@ -478,7 +655,10 @@ class GameManager(Kani):
         retry = 0
         is_model_turn = True
         async with self.lock:
-            self.current_queries = deepcopy(queries)
+            # The summary from the previous turns is added only if it is ready, so that the players do not wait for it.
+            await self.splice_summary()
+
+            self.current_queries = list(queries)
             generate_states = kwargs['generate_states']
             kwargs.pop('generate_states')
 
@@ -489,15 +669,18 @@ class GameManager(Kani):
                 # Recording the current state.
                 context = self.make_context()
 
-                context["past_history"] = []
-                for msg in self.raw_history:
-                    context["past_history"].append(convert_into_dict(msg))
-                context["current_queries"] = []
-                for msg in self.current_queries:
-                    context["current_queries"].append(convert_into_dict(msg))
-                context["actual_prompt"] = []
-                for msg in messages:
-                    context["actual_prompt"].append(convert_into_natural(msg))
+                if self.log_encoder is not None:  # The delta format only stores the newly added messages and state changes.
+                    context = self.log_encoder.encode(context, self.raw_history, self.current_queries, [convert_into_natural(msg) for msg in messages])
+                else:
+                    context["past_history"] = []
+                    for msg in self.raw_history:
+                        context["past_history"].append(convert_into_dict(msg))
+                    context["current_queries"] = []
+                    for msg in self.current_queries:
+                        context["current_queries"].append(convert_into_dict(msg))
+                    context["actual_prompt"] = []
+                    for msg in messages:
+                        context["actual_prompt"].append(convert_into_natural(msg))
                 if self.retrieved_messages is not None:
                     context["retrieved_messages"] = []
                     for msg, score in self.retrieved_messages:
@@ -523,7 +706,7 @@ class GameManager(Kani):
 
                     # If specified, the model updates the game states on its own.
                     if generate_states:
-                        await self.update_states(deepcopy(self.current_queries))
+                        await self.update_states(list(self.current_queries))  # The temporary Kani appends to the list.
 
                     break
 
@@ -575,23 +758,25 @@ class GameManager(Kani):
 
             # After finishing the turn, the current queries should be added to the chat history.
             await self.add_to_history(clean_history(self.current_queries))
+            if self.embedding_cache is not None:
+                log.debug(f"Embedding cache: {self.embedding_cache.get_stats()}")
 
-            # Increasing the turn count. If the summarization period has been reached, adding the summary.
+            # Increasing the turn count. If the summarization period or token budget has been reached, adding the summary.
             self.turn_count += 1
-            if self.summarization and self.summ_period is not None and self.turn_count == self.summ_period:
-                input_history = self.chat_history[self.start_idx:]
-                summary = await self.summarize_history(input_history)
-                await self.add_to_history([summary], store_in_raw=False)
-
-                if self.clear_raw_logs:
-                    self.chat_history = self.chat_history[:self.start_idx] + self.chat_history[-1:]
-                    
-                    if self.sent_embs is not None:
-                        self.sent_embs = np.concatenate((self.sent_embs[:self.start_idx], self.sent_embs[-1:]), axis=0)
-
-                        assert len(self.chat_history) == self.sent_embs.shape[0], "The sentence embeddings and chat histories are not synced."
-                
-                self.start_idx = len(self.chat_history)
+            if self.summarization and self.should_summarize():
+                await self.splice_summary(wait=True)  # The previous summary should be added first to keep the order.
+
+                start, end = self.start_idx, len(self.chat_history)
+                input_history = self.chat_history[start:end]
+                self.start_idx = end
+                if self.async_summarization:  # The summary is added when it is ready, after the turn is returned.
+                    task = asyncio.create_task(self.make_summaries(input_history))
+                    task.add_done_callback(self.log_summary_failure)
+                    self.summary_task = (start, end, task)
+                else:
+                    summary, merges = await self.make_summaries(input_history)
+                    await self.add_summary(start, end, summary, merges)
+
                 self.turn_count = 0
 
     # Overriding do_function_call.
@@ -654,6 +839,47 @@ class GameManager(Kani):
 
     # Updating the game state after every generation.
     async def update_states(self, current_queries: list[ChatMessage]):
+        system_prompt = ' '.join(STATE_PATCH_PROMPT if self.state_update_protocol == 'patch' else STATE_UPDATE_PROMPT)
+        rule_content = '\n'.join([' '.join(part) for part in RULE_SUMMARY])
+        system_prompt = f"{system_prompt}\n\nGame Rules: {rule_content}"
+
+        if self.state_detection == 'batched':
+            update_detected = await self.detect_state_changes_at_once(list(current_queries))
+
+            # The states do not depend on each other, so each changed state is regenerated concurrently with its own Kani.
+            tasks = []
+            if update_detected['scene']:
+                kani = Kani(self.engine, chat_history=list(current_queries), system_prompt=system_prompt)
+                tasks.append(self.try_state_update(self.regenerate_scene_state(kani)))
+            for p, player in enumerate(self.players):
+                if update_detected['players'][p]:
+                    kani = Kani(self.engine, chat_history=list(current_queries), system_prompt=system_prompt)
+                    tasks.append(self.try_state_update(self.regenerate_player_state(kani, player)))
+            await asyncio.gather(*tasks)
+
+        else:
+            # The detection and regeneration share the same history, so each call sees the previous ones.
+            update_detected = await self.detect_state_changes(current_queries)
+
+            kani = Kani(self.engine, chat_history=current_queries, system_prompt=system_prompt)
+            if update_detected['scene']:
+                await self.try_state_update(self.regenerate_scene_state(kani))
+            for p, player in enumerate(self.players):
+                if update_detected['players'][p]:
+                    await self.try_state_update(self.regenerate_player_state(kani, player))
+
+        await self.engine.close()
+
+    # Running one state update.
+    # If the output cannot be used, only this state is kept as it was and the other states and the game go on.
+    async def try_state_update(self, update: Awaitable):
+        try:
+            await update
+        except StateUpdateError as e:
+            log.warning(f"{e} Skipping this update.")
+
+    # Detecting whether the scene and each player state should be updated, one by one.
+    async def detect_state_changes(self, current_queries: list[ChatMessage]) -> dict:
         system_prompt = ' '.join(STATE_DETECT_PROMPT)
         rule_content = '\n'.join([' '.join(part) for part in RULE_SUMMARY])
         system_prompt = f"{system_prompt}\n\nGame Rules: {rule_content}"
@@ -694,12 +920,49 @@ class GameManager(Kani):
             if res == 0:
                 update_detected['players'][p] = True
 
-        # Updating the states.
-        system_prompt = ' '.join(STATE_UPDATE_PROMPT)
+        return update_detected
+
+    # Detecting whether the scene and each player state should be updated in one structured call.
+    # If the output cannot be parsed, the states are checked one by one instead.
+    async def detect_state_changes_at_once(self, current_queries: list[ChatMessage]) -> dict:
+        system_prompt = ' '.join(STATE_BATCH_DETECT_PROMPT)
         rule_content = '\n'.join([' '.join(part) for part in RULE_SUMMARY])
         system_prompt = f"{system_prompt}\n\nGame Rules: {rule_content}"
 
-        kani = Kani(self.engine, chat_history=current_queries, system_prompt=system_prompt)
+        kani = Kani(self.engine, chat_history=list(current_queries), system_prompt=system_prompt)
+        generation_params = {
+            'temperature': 0.2,
+            'top_p': 1,
+            'presence_penalty': 0,
+            'frequency_penalty': 0,
+        }
+
+        scene_prompt = self.make_scene_prompt()
+        players_str = '\n'.join([f"({p+1}) {self.make_player_prompt(player).content}" for p, player in enumerate(self.players)])
+        res = await kani.chat_round_str(
+            f"Should each state be updated based on the dialogue?\n\nPrevious Scene State: {scene_prompt.content}\n\nPrevious Player States:\n{players_str}",
+            **generation_params
+        )
+
+        try:
+            res = json.loads(res)
+
+            assert isinstance(res['scene'], bool), "THE SCENE UPDATE FLAG IS NOT THE BOOLEAN TYPE."
+            assert isinstance(res['players'], list) and len(res['players']) == len(self.players), "THE PLAYER UPDATE FLAGS ARE NOT THE LIST OF ALL PLAYERS."
+            assert all(isinstance(flag, bool) for flag in res['players']), "THE PLAYER UPDATE FLAG IS NOT THE BOOLEAN TYPE."
+
+            return {
+                'scene': res['scene'],
+                'players': res['players']
+            }
+
+        except (json.decoder.JSONDecodeError, TypeError, KeyError, AssertionError) as e:
+            log.debug(res)
+            log.warning(f"{e}: The update flags cannot be parsed. Detecting the state changes one by one.")
+            return await self.detect_state_changes(list(current_queries))
+
+    # Regenerating the scene state.
+    async def regenerate_scene_state(self, kani: Kani):
         generation_params = {
             'temperature': 0,
             'top_p': 1,
@@ -707,43 +970,104 @@ class GameManager(Kani):
             'frequency_penalty': 0
         }
 
-        if update_detected['scene']:
+        prev_scene = self.make_scene_prompt()
+        if self.state_update_protocol == 'patch':
             scene_res = await kani.chat_round_str(
-                f"Generate the updated scene state from the previous scene state considering the given interaction.\n\nPrevious Scene State: {prev_scene.content}",
+                f"Generate the list of the operations to update the previous scene state considering the given interaction.\n\nPrevious Scene State: {prev_scene.content}",
                 **generation_params
             )
-
-            try:
-                new_scene_state = json.loads(scene_res)
+            scene_state = {
+                'npcs': self.npcs,
+                'environment': self.environment,
+                'random_tables': self.random_tables,
+                'is_action_scene': self.is_action_scene
+            }
+            new_scene_state, changed = self.parse_state_patch(scene_res, scene_state)
+            if len(changed) > 0:
                 self.npcs = new_scene_state['npcs']
                 self.environment = new_scene_state['environment']
                 self.random_tables = new_scene_state['random_tables']
                 self.is_action_scene = new_scene_state['is_action_scene']
+                self.mark_scene_changed(*changed)
+            return
 
-            except json.decoder.JSONDecodeError as e:
-                log.debug(scene_res)
-                log.error(f"{e}: The output format cannot be converted into dict.")
-                raise Exception()
+        scene_res = await kani.chat_round_str(
+            f"Generate the updated scene state from the previous scene state considering the given interaction.\n\nPrevious Scene State: {prev_scene.content}",
+            **generation_params
+        )
 
-        for p, player in enumerate(self.players):
-            if update_detected['players'][p]:
-                prev_state = self.make_player_prompt(player)
-                player_res = await kani.chat_round_str(
-                    f"Generate the updated player state from the previous player state considering the given interaction.\n\nPrevious Player State: {prev_state.content}",
-                    **generation_params
-                )
+        try:
+            new_scene_state = json.loads(scene_res)
+            # All properties are read before the update, so a missing one does not leave a half-updated state.
+            npcs, environment = new_scene_state['npcs'], new_scene_state['environment']
+            random_tables, is_action_scene = new_scene_state['random_tables'], new_scene_state['is_action_scene']
+            self.npcs = npcs
+            self.environment = environment
+            self.random_tables = random_tables
+            self.is_action_scene = is_action_scene
+            self.mark_scene_changed('npcs', 'environment', 'random_tables')
+
+        except (json.decoder.JSONDecodeError, TypeError, KeyError) as e:
+            log.debug(scene_res)
+            log.error(f"{e}: The output format cannot be converted into the scene state.")
+            raise StateUpdateError("The scene state cannot be updated.") from e
+
+    # Regenerating one player state.
+    async def regenerate_player_state(self, kani: Kani, player: Player):
+        generation_params = {
+            'temperature': 0,
+            'top_p': 1,
+            'presence_penalty': 0,
+            'frequency_penalty': 0
+        }
+
+        prev_state = self.make_player_prompt(player)
+        if self.state_update_protocol == 'patch':
+            player_res = await kani.chat_round_str(
+                f"Generate the list of the operations to update the previous player state considering the given interaction.\n\nPrevious Player State: {prev_state.content}",
+                **generation_params
+            )
+            player_state = {
+                'traits': player.traits,
+                'flaws': player.flaws,
+                'inventory': player.inventory
+            }
+            new_player_state, changed = self.parse_state_patch(player_res, player_state)
+            if len(changed) > 0:
+                player.traits = new_player_state['traits']
+                player.flaws = new_player_state['flaws']
+                player.inventory = new_player_state['inventory']
+                player.state_version += 1
+            return
+
+        player_res = await kani.chat_round_str(
+            f"Generate the updated player state from the previous player state considering the given interaction.\n\nPrevious Player State: {prev_state.content}",
+            **generation_params
+        )
 
-                try:
-                    new_player_state = json.loads(player_res)
-                    player.traits = new_player_state['traits']
-                    player.flaws = new_player_state['flaws']
-                    player.inventory = new_player_state['inventory']
-                except json.decoder.JSONDecodeError as e:
-                    log.debug(player_res)
-                    log.error(f"{e}: The output format cannot be converted into dict.")
-                    raise Exception()
+        try:
+            new_player_state = json.loads(player_res)
+            traits, flaws, inventory = new_player_state['traits'], new_player_state['flaws'], new_player_state['inventory']  # All properties are read before the update.
+            player.traits = traits
+            player.flaws = flaws
+            player.inventory = inventory
+            player.state_version += 1
+        except (json.decoder.JSONDecodeError, TypeError, KeyError) as e:
+            log.debug(player_res)
+            log.error(f"{e}: The output format cannot be converted into the player state.")
+            raise StateUpdateError(f"The state of {player.name} cannot be updated.") from e
+
+    # Parsing the patch operations and applying them to the state.
+    # The patch is validated as a whole before anything is changed, so a wrong operation never leaves a half-updated state.
+    # Returns the new state and the fields which have been changed.
+    def parse_state_patch(self, res: str, state: dict) -> Tuple[dict, list[str]]:
+        try:
+            return apply_state_patch(state, json.loads(res), list(state.keys()))
 
-        await kani.engine.close()         
+        except (json.decoder.JSONDecodeError, StateUpdateError) as e:
+            log.debug(res)
+            log.error(f"{e}: The output cannot be applied as a patch.")
+            raise StateUpdateError("The patch cannot be applied to the state.") from e
 
     # Kani's function call for a dice roll test.
     @ai_function
@@ -839,6 +1163,7 @@ class GameManager(Kani):
         arguments, intermediate_res = None, None
 
         self.is_action_scene = True
+        self.mark_scene_changed()
         msg = "ACTION SCENE ACTIVATED."
         print_system_log(msg, after_break=True)
         return msg, arguments, intermediate_res
@@ -853,6 +1178,7 @@ class GameManager(Kani):
         arguments, intermediate_res = None, None
 
         self.is_action_scene = False
+        self.mark_scene_changed()
         msg = "ACTION SCENE TERMINATED."
         print_system_log(msg, after_break=True)
         return msg, arguments, intermediate_res
@@ -902,6 +1228,7 @@ class GameManager(Kani):
             assert isinstance(res['flaw'], str), "THE FLAWS OF AN NPC IS NOT THE STRING TYPE."
 
             self.npcs[npc_name] = res
+            self.mark_scene_changed('npcs')
 
             intermediate_res = {f"Generated information of the NPC '{npc_name}'": res}
 
@@ -1183,6 +1510,7 @@ class GameManager(Kani):
         if res == 0: 
             msg = f"THE PLAYER {player_name} USED THE ITEM {item_name}. SINCE THE ITEM IS AN EXPENDABLE ONE, IT IS NOT AVAILABLE ANYMORE."
             player.inventory[item_name] += " (No longer available)"
+            player.state_version += 1
         print_system_log(msg, after_break=True)
         return msg, arguments, intermediate_res
 
@@ -1205,6 +1533,7 @@ class GameManager(Kani):
             return msg, arguments, None
 
         self.environment[object_name] = object_desc
+        self.mark_scene_changed('environment')
 
         msg = f"A NEW OBJECT {object_name} HAS BEEN ADDED TO THE ENVIRONMENT IN THE CURRENT SCENE."
         print_system_log(msg, after_break=True)
@@ -1229,6 +1558,7 @@ class GameManager(Kani):
             return msg, arguments, None
 
         self.environment.pop(object_name)
+        self.mark_scene_changed('environment')
 
         msg = f"THE OBJECT {object_name} HAS BEEN REMOVED FROM THE ENVIRONMENT IN THE CURRENT SCENE."
         print_system_log(msg, after_break=True)
@@ -1294,6 +1624,7 @@ class GameManager(Kani):
         self.random_tables[table_name] = entries
         if len(entries) == 0:
             self.random_tables.pop(table_name)
+        self.mark_scene_changed('random_tables')
         intermediate_res["Exclusion of the sampled entries"] = True if exclusion_idx == 0 else False
 
         # 4. Determining whether the random table should be removed or not.
@@ -1306,6 +1637,7 @@ class GameManager(Kani):
             removal_idx = convert_into_class_idx(res, removal_options)
             if removal_idx == 0:
                 self.random_tables.pop(table_name)
+                self.mark_scene_changed('random_tables')
             intermediate_res["Removal of the table"] = True if removal_idx == 0 else False
 
         samples_str = '\n'.join(samples)
@@ -1313,6 +1645,53 @@ class GameManager(Kani):
         print_system_log(msg, after_break=True)
         return msg, arguments, intermediate_res
 
+    # Validating the success and failure conditions together.
+    # The two validations run concurrently, and they are skipped if the raw history and the conditions have not changed since the last validation.
+    async def validate_conditions(self) -> Tuple[bool, bool]:
+        key = (len(self.raw_history), self.raw_history[-1] if len(self.raw_history) > 0 else None, self.success_condition, self.failure_condition)
+        if self.last_validation is not None:
+            last_key, result = self.last_validation
+            if last_key[0] == key[0] and last_key[1] is key[1] and last_key[2:] == key[2:]:
+                return result
+
+        succ, fail = await asyncio.gather(self.validate_success_condition(), self.validate_failure_condition())
+        self.last_validation = (key, (succ, fail))
+        return succ, fail
+
+    # Getting the chat history for validating a condition.
+    # full: The whole raw history. window: The last validation_window messages.
+    # retrieval: The earlier messages most relevant to the condition + the last messages.
+    # summary: The summary of the earlier messages + the last messages.
+    async def get_validation_history(self, condition: str) -> list[ChatMessage]:
+        if self.validation_policy == 'full':
+            return list(self.raw_history)  # The temporary Kani appends to the list.
+
+        num_earlier = max(len(self.raw_history) - self.validation_window, 0)
+        recent = self.raw_history[num_earlier:]
+        if self.validation_policy == 'window' or num_earlier == 0:
+            return recent
+
+        if self.validation_policy == 'retrieval':
+            # The raw history is append-only, so only the messages which have newly left the window are encoded.
+            async with self.validation_lock:
+                if len(self.validation_embs) < num_earlier:
+                    embs = await self.encode_messages(self.raw_history[len(self.validation_embs):num_earlier])  # (N, d)
+                    self.validation_embs.append(embs)
+
+            query_embs = await self.embedding_cache.encode_async([condition])  # (1, d)
+            candidates, scores = self.validation_embs.search(query_embs)  # (C), (C)
+            idxs, _ = max_pooled_top_k(scores, self.validation_window)  # Ascending, so the chronological order is kept.
+            return [self.raw_history[candidates[idx]] for idx in idxs] + recent
+
+        if self.validation_policy == 'summary':
+            # Only the messages which have newly left the window are folded into the previous summary.
+            async with self.validation_lock:
+                if self.num_validation_summarized < num_earlier:
+                    input_history = ([self.validation_summary] if self.validation_summary is not None else []) + self.raw_history[self.num_validation_summarized:num_earlier]
+                    self.validation_summary = await self.summarize_history(input_history, fold=True)
+                    self.num_validation_summarized = num_earlier
+            return [self.validation_summary] + recent
+
     # Validating if the current interaction falls into the success condition.
     async def validate_success_condition(self):
         if len(self.success_condition) == 0:
@@ -1323,7 +1702,7 @@ class GameManager(Kani):
 
         options = ['Succeeded', 'Not yet']
         options_str = '\n'.join([f"{o}: {option}" for o, option in enumerate(options)])
-        kani = Kani(self.engine, chat_history=deepcopy(self.raw_history), system_prompt=system_prompt)
+        kani = Kani(self.engine, chat_history=await self.get_validation_history(self.success_condition), system_prompt=system_prompt)
         generation_params = {
             'temperature': 0.2,
             'top_p': 1,
@@ -1346,7 +1725,7 @@ class GameManager(Kani):
 
         options = ['Failed', 'Not yet']
         options_str = '\n'.join([f"{o}: {option}" for o, option in enumerate(options)])
-        kani = Kani(self.engine, chat_history=deepcopy(self.raw_history), system_prompt=system_prompt)
+        kani = Kani(self.engine, chat_history=await self.get_validation_history(self.failure_condition), system_prompt=system_prompt)
         generation_params = {
             'temperature': 0.2,
             'top_p': 1,
@@ -1,8 +1,7 @@
 from kani import Kani
-from kani.models import ChatMessage, ChatRole
-from kani.exceptions import MessageTooLong
+from kani.models import ChatMessage
+from token_lengths import TokenLengthCache, PrefixTokenLengths
 from constants import RULE_SUMMARY
-from copy import deepcopy
 
 import logging
 import warnings
@@ -26,6 +25,10 @@ class Player():
 
         self.additional_notes = kwargs['additional_notes']
 
+        self.state_version = 0  # Increased whenever the player state is changed, so the cached player prompts are reused until then.
+        self.state_prompt = None  # (version, prompt) of the last player prompt made by the game manager.
+        self.state_snapshot = None  # (version, copy) of the player state shared by the exported contexts.
+
     # Getter for persona in a (numbered) list format.
     def get_persona(self, with_number=False):
         if with_number:
@@ -81,26 +84,32 @@ class Player():
     # Adding a trait.
     def add_trait(self, trait, desc):
         self.traits[trait] = desc
+        self.state_version += 1
     
     # Adding a flaw.
     def add_flaw(self, flaw, desc):
         self.flaws[flaw] = desc
+        self.state_version += 1
     
     # Adding an item.
     def add_item(self, item, desc):
         self.inventory[item] = desc
+        self.state_version += 1
 
     # Removing a trait.
     def remove_trait(self, trait):
         self.traits.pop(trait)
+        self.state_version += 1
 
     # Removing a flaw.
     def remove_flaw(self, flaw):
         self.flaws.pop(flaw)
+        self.state_version += 1
 
     # Removing an item.
     def remove_item(self, item):
         self.inventory.pop(item)
+        self.state_version += 1
 
 
 # Kani version of Player class.
@@ -113,13 +122,21 @@ class PlayerKani(Player, Kani):
         rule_content = '\n'.join([' '.join(part) for part in RULE_SUMMARY])
         self.rule_prompt = ChatMessage.system(name="Game_Rules", content=rule_content)
         self.player_prompt = None
+        self.player_prompt_version = None  # The state version which the player prompt has been made from.
+
+        # The memoized token lengths of the messages and the prefix sums of the chat history.
+        self.token_lens = TokenLengthCache(super().message_token_len)
+        self.history_lens = PrefixTokenLengths(self.message_token_len)
 
-    # Making the player prompt.
+    # Making the player prompt. The previous one is reused if the player state has not been changed since then.
     def make_player_prompt(self):
+        if self.player_prompt is not None and self.player_prompt_version == self.state_version:
+            return
         content = f"name={self.name}, kin={self.kin}, persona={self.persona}, goal={self.goal}, " + \
             f"traits={self.traits}, flaws={self.flaws}, inventory={self.inventory}, " + \
             f"additional_notes={self.additional_notes}"
         self.player_prompt = ChatMessage.system(name="Player_State", content=content)
+        self.player_prompt_version = self.state_version
 
     # Overriding get_prompt.
     async def get_prompt(self) -> list[ChatMessage]:
@@ -137,37 +154,16 @@ class PlayerKani(Player, Kani):
         player_prompt_len = self.message_token_len(self.player_prompt)
         always_len = self.always_len + rule_prompt_len + player_prompt_len
 
-        remaining = max_size = self.max_context_size - always_len
-        total_tokens = 0
-        to_keep = 0  # messages to keep from the end of chat history
-        for message in reversed(self.chat_history):
-            # get and check the message's length
-            message_len = self.message_token_len(message)
-            if message_len > max_size:
-                func_help = (
-                    ""
-                    if message.role != ChatRole.FUNCTION
-                    else "You may set `auto_truncate` in the @ai_function to automatically truncate long responses.\n"
-                )
-                raise MessageTooLong(
-                    "The chat message's size is longer than the allowed context window (after including system"
-                    " messages, always included messages, and desired response tokens).\n"
-                    f"{func_help}Content: {message.text[:100]}..."
-                )
-            # see if we can include it
-            remaining -= message_len
-            if remaining >= 0:
-                total_tokens += message_len
-                to_keep += 1
-            else:
-                break
+        max_size = self.max_context_size - always_len
+        self.history_lens.sync(self.chat_history)
+        to_keep, total_tokens = self.history_lens.truncate(max_size)  # Binary search on the prefix sums of the token lengths.
         log.debug(
             f"get_prompt() returned {always_len + total_tokens} tokens ({always_len} always) in"
             f" {len(self.always_included_messages) + to_keep} messages"
             f" ({len(self.always_included_messages)} always)"
         )
 
-        default_prompt = deepcopy(self.always_included_messages)
+        default_prompt = list(self.always_included_messages)
         if self.rule_prompt is not None:
             default_prompt += [self.rule_prompt]
         if self.player_prompt is not None:
@@ -179,6 +175,10 @@ class PlayerKani(Player, Kani):
 
         return prompt
 
+    # Overriding message_token_len to look up the memoized lengths by the message identity first.
+    def message_token_len(self, message: ChatMessage):
+        return self.token_lens(message)
+
     # Overrding chat_round.
     async def chat_round(self, queries: list[ChatMessage], **kwargs) -> ChatMessage:
         """Perform a single chat round (user -> model -> user, no functions allowed).
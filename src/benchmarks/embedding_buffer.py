@@ -0,0 +1,61 @@
+import os
+import sys
+
+cur_dir = os.path.dirname(__file__)
+src_path = os.path.abspath(os.path.join(cur_dir, '..'))
+sys.path.insert(0, src_path)
+
+from embeddings import EmbeddingBuffer
+
+import argparse
+import time
+import numpy as np
+
+
+# Appending the embeddings by re-allocating the whole matrix every time. (The previous implementation.)
+def append_by_concat(num_msgs: int, dim: int, msgs_per_turn: int, checkpoints: list[int]):
+    sent_embs = np.empty((0, dim))
+    embs = np.random.rand(msgs_per_turn, dim)
+    res, start = {}, time.perf_counter()
+    while sent_embs.shape[0] < num_msgs:
+        sent_embs = np.concatenate((sent_embs, embs))
+        if sent_embs.shape[0] in checkpoints:
+            res[sent_embs.shape[0]] = time.perf_counter() - start
+            start = time.perf_counter()
+    return res
+
+
+# Appending the embeddings into the growable buffer.
+def append_by_buffer(num_msgs: int, dim: int, msgs_per_turn: int, checkpoints: list[int]):
+    sent_embs = EmbeddingBuffer(dim)
+    embs = np.random.rand(msgs_per_turn, dim)
+    res, start = {}, time.perf_counter()
+    while len(sent_embs) < num_msgs:
+        sent_embs.append(embs)
+        if len(sent_embs) in checkpoints:
+            res[len(sent_embs)] = time.perf_counter() - start
+            start = time.perf_counter()
+    return res
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_msgs', type=int, default=32000, help="The total number of messages to append.")
+    parser.add_argument('--dim', type=int, default=768, help="The dimension of the sentence embeddings.")
+    parser.add_argument('--msgs_per_turn', type=int, default=4, help="The number of messages appended at once.")
+    parser.add_argument('--num_bins', type=int, default=8, help="The number of bins to report.")
+
+    args = parser.parse_args()
+
+    bin_size = args.num_msgs // args.num_bins
+    bin_size -= bin_size % args.msgs_per_turn
+    checkpoints = [bin_size * (b+1) for b in range(args.num_bins)]
+
+    concat_res = append_by_concat(args.num_msgs, args.dim, args.msgs_per_turn, checkpoints)
+    buffer_res = append_by_buffer(args.num_msgs, args.dim, args.msgs_per_turn, checkpoints)
+
+    # The average cost per append call in each bin.
+    num_calls = bin_size // args.msgs_per_turn
+    print(f"{'N':>10} {'concat (us/append)':>20} {'buffer (us/append)':>20}")
+    for n in checkpoints:
+        print(f"{n:>10} {concat_res[n] / num_calls * 1e6:>20.2f} {buffer_res[n] / num_calls * 1e6:>20.2f}")
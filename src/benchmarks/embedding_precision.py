@@ -0,0 +1,80 @@
+import os
+import sys
+
+cur_dir = os.path.dirname(__file__)
+src_path = os.path.abspath(os.path.join(cur_dir, '..'))
+sys.path.insert(0, src_path)
+
+from embeddings import EmbeddingBuffer, PRECISIONS
+from constants import RULE_SUMMARY
+from itertools import chain
+
+import argparse
+import numpy as np
+
+
+# Making the synthetic embeddings which are clustered like the chat messages in the same topic.
+def make_synthetic_embeddings(num_cands: int, num_queries: int, dim: int, num_clusters: int=100):
+    centers = np.random.randn(num_clusters, dim)
+    cands = centers[np.random.randint(num_clusters, size=num_cands)] + 0.8 * np.random.randn(num_cands, dim)
+    queries = centers[np.random.randint(num_clusters, size=num_queries)] + 0.8 * np.random.randn(num_queries, dim)
+    return cands, queries
+
+
+# Encoding the rule sentences as the candidates and the rule paragraphs as the queries.
+def make_rule_embeddings():
+    from sentence_transformers import SentenceTransformer
+    encoder = SentenceTransformer('all-mpnet-base-v2')
+    cands = encoder.encode(list(chain.from_iterable(RULE_SUMMARY)))
+    queries = encoder.encode([' '.join(part) for part in RULE_SUMMARY])
+    return cands, queries
+
+
+# The top-k indices based on the max-pooled similarities.
+def get_top_k(sims: np.ndarray, k: int):
+    scores = sims.max(axis=0)
+    return set(np.argsort(-scores, kind='stable')[:k].tolist())
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--seed', type=int, default=0, help="The random seed for the synthetic embeddings.")
+    parser.add_argument('--dim', type=int, default=768, help="The dimension of the sentence embeddings.")
+    parser.add_argument('--num_cands', type=int, default=10000, help="The number of candidate messages.")
+    parser.add_argument('--num_trials', type=int, default=200, help="The number of retrieval trials.")
+    parser.add_argument('--num_queries', type=int, default=4, help="The number of queries per trial.")
+    parser.add_argument('--top_k', type=int, default=5, help="The number of messages to retrieve.")
+    parser.add_argument('--use_encoder', action='store_true', help="Using the actual sentence encoder on the game rules instead of the synthetic embeddings.")
+
+    args = parser.parse_args()
+    np.random.seed(args.seed)
+
+    # 1. The memory per 10k messages.
+    print("MEMORY PER 10K MESSAGES")
+    for precision in PRECISIONS:
+        buffer = EmbeddingBuffer(args.dim, precision=precision)
+        buffer.append(np.random.randn(10000, args.dim))
+        print(f"{precision:>8}: {buffer.nbytes / 2**20:.2f} MiB")
+    print()
+
+    # 2. The top-k agreement with the float64 retrieval.
+    if args.use_encoder:
+        cands, queries = make_rule_embeddings()
+        query_groups = [queries[q:q+1] for q in range(queries.shape[0])]
+    else:
+        cands, queries = make_synthetic_embeddings(args.num_cands, args.num_trials * args.num_queries, args.dim)
+        query_groups = [queries[t*args.num_queries:(t+1)*args.num_queries] for t in range(args.num_trials)]
+
+    buffers = {}
+    for precision in PRECISIONS:
+        buffers[precision] = EmbeddingBuffer(cands.shape[1], precision=precision)
+        buffers[precision].append(cands)
+
+    print(f"TOP-{args.top_k} AGREEMENT WITH FLOAT64 ({len(query_groups)} trials, {cands.shape[0]} candidates)")
+    for precision in PRECISIONS:
+        agreement = []
+        for query_embs in query_groups:
+            ref = get_top_k(buffers['float64'].similarity(query_embs), args.top_k)
+            res = get_top_k(buffers[precision].similarity(query_embs), args.top_k)
+            agreement.append(len(ref & res) / args.top_k)
+        print(f"{precision:>8}: {np.mean(agreement):.4f}")
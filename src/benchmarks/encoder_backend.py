@@ -0,0 +1,71 @@
+import os
+import sys
+
+cur_dir = os.path.dirname(__file__)
+src_path = os.path.abspath(os.path.join(cur_dir, '..'))
+sys.path.insert(0, src_path)
+
+from embeddings import SharedEncoder, EmbeddingBuffer, ENCODER_BACKENDS, normalize_embeddings
+from retrieval import max_pooled_top_k
+from constants import RULE_SUMMARY, RULE_QUESTIONS, SENTENCE_ENCODER
+from itertools import chain
+
+import argparse
+import time
+import numpy as np
+
+
+# The median latency of encoding the texts in milliseconds.
+def measure(encoder: SharedEncoder, contents: list[str], num_runs: int):
+    elapsed = []
+    for _ in range(num_runs):
+        start = time.perf_counter()
+        encoder.encode(contents)
+        elapsed.append(time.perf_counter() - start)
+    return np.median(elapsed) * 1e3
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_threads', type=int, help="The number of CPU threads for the encoders.")
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 4, 16], help="The numbers of texts in one encode call.")
+    parser.add_argument('--num_runs', type=int, default=20, help="The number of runs for each batch size.")
+    parser.add_argument('--top_n', type=int, default=5, help="The number of rules to retrieve for the agreement.")
+
+    args = parser.parse_args()
+
+    rules = list(chain.from_iterable(RULE_SUMMARY))
+    texts = rules + RULE_QUESTIONS
+
+    encoders = {backend: SharedEncoder(SENTENCE_ENCODER, backend, args.num_threads) for backend in ENCODER_BACKENDS}
+    for encoder in encoders.values():
+        encoder.encode(texts[:4])  # Warming up.
+
+    # 1. The encode latency.
+    print("ENCODE LATENCY (ms)")
+    print(f"{'batch':>6} | " + ' | '.join(f"{backend:>10}" for backend in encoders))
+    for batch_size in args.batch_sizes:
+        batch = texts[:batch_size]
+        print(f"{batch_size:>6} | " + ' | '.join(f"{measure(encoder, batch, args.num_runs):>10.2f}" for encoder in encoders.values()))
+    print()
+
+    # 2. The agreement with the torch backend.
+    ref_embs = normalize_embeddings(encoders['torch'].encode(texts))
+    ref_rules = EmbeddingBuffer(precision='float32')
+    ref_rules.append(encoders['torch'].encode(rules))
+
+    print(f"AGREEMENT WITH TORCH ({len(RULE_QUESTIONS)} rule questions, top-{args.top_n})")
+    for backend, encoder in encoders.items():
+        if backend == 'torch':
+            continue
+        embs = normalize_embeddings(encoder.encode(texts))
+        cos = np.mean(np.sum(embs * ref_embs, axis=-1))
+
+        rule_embs = EmbeddingBuffer(precision='float32')
+        rule_embs.append(encoder.encode(rules))
+        overlap = []
+        for question in RULE_QUESTIONS:
+            ref_idxs, _ = max_pooled_top_k(ref_rules.similarity(encoders['torch'].encode([question])), args.top_n)
+            idxs, _ = max_pooled_top_k(rule_embs.similarity(encoder.encode([question])), args.top_n)
+            overlap.append(len(set(idxs.tolist()) & set(ref_idxs.tolist())) / args.top_n)
+        print(f"{backend:>10}: mean cosine with torch embeddings {cos:.4f} | top-{args.top_n} rule overlap {np.mean(overlap):.4f}")
@@ -0,0 +1,64 @@
+import os
+import sys
+
+cur_dir = os.path.dirname(__file__)
+src_path = os.path.abspath(os.path.join(cur_dir, '..'))
+sys.path.insert(0, src_path)
+
+from statistics import median
+
+import argparse
+import subprocess
+
+ENTRY_POINTS = [
+    'main.py',
+    'evaluation/run_unit_tests.py',
+    'evaluation/evaluate_extra.py',
+    'evaluation/evaluate_main.py',
+    'evaluation/export_survey.py',
+]
+HEAVY_MODULES = ['torch', 'sentence_transformers', 'transformers']
+
+# Loading the entry point as a module, so that only the imports are executed. (The scripts are guarded by __main__.)
+LOADER = """
+import sys, importlib.util
+sys.path.insert(0, {src_path!r})
+spec = importlib.util.spec_from_file_location('entry_point', {path!r})
+spec.loader.exec_module(importlib.util.module_from_spec(spec))
+"""
+
+
+# Measuring the import time of one entry point in a fresh interpreter.
+def measure(path: str):
+    code = LOADER.format(src_path=src_path, path=os.path.join(src_path, path))
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], capture_output=True, text=True, cwd=src_path)
+    assert proc.returncode == 0, f"Importing {path} failed: {proc.stderr.strip().splitlines()[-1]}"
+
+    total, modules = 0, {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = [v.strip() for v in line[len('import time:'):].split('|')]
+        total += int(self_us)
+        modules[name] = int(cumulative_us)
+    return total, modules
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_runs', type=int, default=5, help="The number of runs for each entry point. The median is reported.")
+    parser.add_argument('--top_k', type=int, default=5, help="The number of the slowest top-level modules to show.")
+
+    args = parser.parse_args()
+
+    for path in ENTRY_POINTS:
+        totals, modules = [], {}
+        for _ in range(args.num_runs):
+            total, modules = measure(path)
+            totals.append(total)
+
+        heavy = [name for name in HEAVY_MODULES if name in modules]
+        print(f"{path}: {median(totals) / 1e3:.1f} ms (heavy modules: {', '.join(heavy) if len(heavy) > 0 else 'none'})")
+        top_level = sorted([(v, name) for name, v in modules.items() if '.' not in name], reverse=True)[:args.top_k]
+        for v, name in top_level:
+            print(f"    {name}: {v / 1e3:.1f} ms")
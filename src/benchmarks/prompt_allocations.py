@@ -0,0 +1,87 @@
+import os
+import sys
+
+cur_dir = os.path.dirname(__file__)
+src_path = os.path.abspath(os.path.join(cur_dir, '..'))
+sys.path.insert(0, src_path)
+
+from kani.models import ChatMessage
+from agents.manager import GameManager
+from state_snapshot import make_scene, make_manager
+from copy import deepcopy
+
+import argparse
+import asyncio
+import time
+import tracemalloc
+
+
+# The copies in one turn by deep-copying the messages. (The previous implementation.)
+# The prompt parts are copied in get_prompt, the queries in full_round and update_states, and the raw history in the two validations.
+def copy_by_value(manager: GameManager, queries: list[ChatMessage], prompt_parts: list[ChatMessage]):
+    deepcopy(prompt_parts)
+    manager.current_queries = deepcopy(queries)
+    deepcopy(manager.current_queries)
+    deepcopy(manager.raw_history)
+    deepcopy(manager.raw_history)
+
+
+# The copies in one turn by sharing the messages by reference.
+def copy_by_reference(manager: GameManager, queries: list[ChatMessage], prompt_parts: list[ChatMessage]):
+    list(prompt_parts)
+    manager.current_queries = list(queries)
+    list(manager.current_queries)
+    list(manager.raw_history)
+    list(manager.raw_history)
+
+
+# The peak allocated memory in KiB and the elapsed time in milliseconds of one turn.
+def measure(copy_fn, manager: GameManager, queries: list[ChatMessage], prompt_parts: list[ChatMessage]):
+    tracemalloc.start()
+    base, _ = tracemalloc.get_traced_memory()
+    start = time.perf_counter()
+    copy_fn(manager, queries, prompt_parts)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return (peak - base) / 1024, elapsed * 1e3
+
+
+# The peak allocated memory in KiB of get_prompt after all token lengths are cached.
+async def measure_get_prompt(manager: GameManager):
+    await manager.get_prompt()
+    tracemalloc.start()
+    base, _ = tracemalloc.get_traced_memory()
+    await manager.get_prompt()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return (peak - base) / 1024
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 5000, 20000], help="The numbers of messages in the history.")
+    parser.add_argument('--num_tables', type=int, default=10, help="The number of random tables in the scene.")
+    parser.add_argument('--num_players', type=int, default=4, help="The number of players.")
+
+    args = parser.parse_args()
+
+    print(f"{'size':>7} | {'deepcopy (KiB)':>14} | {'deepcopy (ms)':>13} | {'reference (KiB)':>15} | {'reference (ms)':>14} | {'get_prompt (KiB)':>16}")
+    for size in args.sizes:
+        manager = make_manager(make_scene(args.num_tables, 20, 20), args.num_players)
+        for m in range(size):
+            if m % 2 == 0:
+                message = ChatMessage.user(name=f"Player {m % args.num_players}", content=f"The message {m} from the player in the game.")
+            else:
+                message = ChatMessage.assistant(name="Goblin_King", content=f"The response {m} from the game manager to the players.")
+            manager.chat_history.append(message)
+            manager.raw_history.append(message)
+
+        queries = [ChatMessage.user(name="Player 0", content="What do I see around me?")]
+        manager.current_queries = list(queries)
+        prompt_parts = manager.always_included_messages + [manager.make_scene_prompt()] + manager.make_player_prompts()
+
+        value_kib, value_ms = measure(copy_by_value, manager, queries, prompt_parts)
+        ref_kib, ref_ms = measure(copy_by_reference, manager, queries, prompt_parts)
+        prompt_kib = asyncio.run(measure_get_prompt(manager))
+        print(f"{size:>7} | {value_kib:>14.1f} | {value_ms:>13.2f} | {ref_kib:>15.1f} | {ref_ms:>14.3f} | {prompt_kib:>16.1f}")
@@ -0,0 +1,71 @@
+import os
+import sys
+
+cur_dir = os.path.dirname(__file__)
+src_path = os.path.abspath(os.path.join(cur_dir, '..'))
+sys.path.insert(0, src_path)
+
+from retrieval import ExactIndex, IVFIndex
+
+import argparse
+import time
+import numpy as np
+
+
+# Making the synthetic message embeddings around the topic vectors, since the real chat logs are clustered by topic.
+def make_embeddings(rng: np.random.Generator, num_embs: int, dim: int, num_topics: int, noise: float):
+    topics = rng.standard_normal((num_topics, dim))
+    return topics[rng.integers(num_topics, size=num_embs)] + noise * rng.standard_normal((num_embs, dim))
+
+
+# Getting the top-n message indices from the search result.
+def get_top_n(candidates: np.ndarray, scores: np.ndarray, top_n: int):
+    return set(candidates[np.argsort(-scores)[:top_n]].tolist())
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000], help="The numbers of messages in the history.")
+    parser.add_argument('--dim', type=int, default=768, help="The dimension of the sentence embeddings.")
+    parser.add_argument('--num_topics', type=int, default=200, help="The number of topics of the synthetic embeddings.")
+    parser.add_argument('--noise', type=float, default=1.0, help="The scale of the noise around each topic.")
+    parser.add_argument('--num_queries', type=int, default=3, help="The number of current queries in each search.")
+    parser.add_argument('--top_n', type=int, default=20, help="The number of messages to retrieve.")
+    parser.add_argument('--num_searches', type=int, default=50, help="The number of searches for each size.")
+    parser.add_argument('--msgs_per_turn', type=int, default=4, help="The number of messages added at once.")
+    parser.add_argument('--seed', type=int, default=0, help="The random seed.")
+
+    args = parser.parse_args()
+    rng = np.random.default_rng(args.seed)
+
+    print(f"{'size':>8} | {'index':>6} | {'build (s)':>10} | {'max append (ms)':>15} | {'search (ms)':>11} | {'recall@' + str(args.top_n):>10}")
+    for size in args.sizes:
+        embs = make_embeddings(rng, size, args.dim, args.num_topics, args.noise).astype('float32')
+        queries = [embs[rng.integers(size, size=args.num_queries)] + args.noise * rng.standard_normal((args.num_queries, args.dim)) for _ in range(args.num_searches)]
+
+        results = {}
+        for index in [ExactIndex(), IVFIndex(threshold=min(size, 4096))]:
+            name = 'exact' if type(index) is ExactIndex else 'ivf'
+
+            # Adding the embeddings incrementally as in the game.
+            # The max append time is how long the event loop can be blocked by one append. (The training runs in the background.)
+            append_times = []
+            for i in range(0, size, args.msgs_per_turn):
+                start = time.perf_counter()
+                index.append(embs[i:i+args.msgs_per_turn])
+                append_times.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            if isinstance(index, IVFIndex):
+                index.wait_training()  # The search is measured with the latest centroids.
+            build_time = sum(append_times) + time.perf_counter() - start
+
+            results[name], elapsed = [], []
+            for query_embs in queries:
+                start = time.perf_counter()
+                candidates, scores = index.search(query_embs, min_candidates=args.top_n)
+                top_n = get_top_n(candidates, scores, args.top_n)
+                elapsed.append(time.perf_counter() - start)
+                results[name].append(top_n)
+
+            recall = np.mean([len(res & ref) / args.top_n for res, ref in zip(results[name], results['exact'])])
+            print(f"{size:>8} | {name:>6} | {build_time:>10.3f} | {max(append_times) * 1e3:>15.2f} | {np.median(elapsed) * 1e3:>11.3f} | {recall:>10.3f}")
@@ -0,0 +1,63 @@
+import os
+import sys
+
+cur_dir = os.path.dirname(__file__)
+src_path = os.path.abspath(os.path.join(cur_dir, '..'))
+sys.path.insert(0, src_path)
+
+from retrieval import BM25Index, max_pooled_top_k, reciprocal_rank_fusion
+from embeddings import EmbeddingBuffer
+from constants import RULE_SUMMARY, RULE_QUESTIONS, SENTENCE_ENCODER
+from itertools import chain
+
+import argparse
+import time
+import numpy as np
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--top_n', type=int, default=5, help="The number of rules to retrieve.")
+    parser.add_argument('--num_runs', type=int, default=20, help="The number of runs for each question to measure the latency.")
+    parser.add_argument('--use_encoder', action='store_true', help="Also running the dense and hybrid retrieval with the actual sentence encoder.")
+    parser.add_argument('--show_rules', action='store_true', help="Printing the retrieved rules for each question.")
+
+    args = parser.parse_args()
+
+    rules = list(chain.from_iterable(RULE_SUMMARY))
+    start = time.perf_counter()
+    rule_index = BM25Index(rules)
+    print(f"Building the inverted index over {len(rules)} rules: {(time.perf_counter() - start) * 1e3:.3f} ms")
+
+    # The scoring function of each mode which returns the scores of all rules for a question.
+    modes = {'lexical': lambda question: rule_index.score([question]).max(axis=0)}
+    if args.use_encoder:
+        from embeddings import get_encoder
+        encoder = get_encoder(SENTENCE_ENCODER)
+        rule_embs = EmbeddingBuffer(precision='float32')
+        rule_embs.append(encoder.encode(rules))
+
+        modes['retrieval'] = lambda question: rule_embs.similarity(encoder.encode([question])).max(axis=0)
+        modes['hybrid'] = lambda question: reciprocal_rank_fusion([modes['retrieval'](question), modes['lexical'](question)])
+
+    results, latencies = {mode: [] for mode in modes}, {mode: [] for mode in modes}
+    for q, question in enumerate(RULE_QUESTIONS):
+        for mode, score_fn in modes.items():
+            for _ in range(args.num_runs):
+                start = time.perf_counter()
+                idxs, _ = max_pooled_top_k(score_fn(question), args.top_n)
+                latencies[mode].append(time.perf_counter() - start)
+            results[mode].append(set(idxs.tolist()))
+
+            if args.show_rules:
+                print(f"Q{q+1} [{mode}] {question}")
+                for idx in idxs:
+                    print(f"    - {rules[idx]}")
+
+    print(f"\nRETRIEVAL OVER {len(RULE_QUESTIONS)} RULE QUESTIONS (top-{args.top_n})")
+    for mode in modes:
+        line = f"{mode:>9}: {np.median(latencies[mode]) * 1e6:>10.1f} us/question"
+        if 'retrieval' in results and mode != 'retrieval':
+            overlap = np.mean([len(res & ref) / args.top_n for res, ref in zip(results[mode], results['retrieval'])])
+            line += f" | overlap with retrieval: {overlap:.3f}"
+        print(line)
@@ -0,0 +1,126 @@
+import os
+import sys
+
+cur_dir = os.path.dirname(__file__)
+src_path = os.path.abspath(os.path.join(cur_dir, '..'))
+sys.path.insert(0, src_path)
+
+from kani.engines.openai import OpenAIEngine
+from agents.player import Player
+from agents.manager import GameManager
+from argparse import Namespace
+from copy import deepcopy
+
+import argparse
+import time
+import numpy as np
+
+
+# Making the context by deep-copying all states in every step. (The previous implementation.)
+def deepcopy_context(manager: GameManager):
+    context = {
+        "scene": {
+            "chapter": manager.chapter,
+            "scene": manager.scene,
+            "scene_summary": deepcopy(manager.scene_summary),
+            "npcs": deepcopy(manager.npcs),
+            "success_condition": manager.success_condition,
+            "failure_condition": manager.failure_condition,
+            "game_flow": deepcopy(manager.game_flow),
+            "environment": deepcopy(manager.environment),
+            "random_tables": deepcopy(manager.random_tables),
+            "consequences": manager.consequences,
+            "is_action_scene": manager.is_action_scene
+        },
+    }
+    players = []
+    for player in manager.players:
+        players.append({
+            "name": player.name,
+            "kin": player.kin,
+            "persona": deepcopy(player.persona),
+            "goal": player.goal,
+            "traits": deepcopy(player.traits),
+            "flaws": deepcopy(player.flaws),
+            "inventory": deepcopy(player.inventory),
+            "additional_notes": deepcopy(player.additional_notes)
+        })
+    context["players"] = players
+
+    return context
+
+
+# Making a scene with the large random tables and NPCs.
+def make_scene(num_tables: int, entries_per_table: int, num_npcs: int):
+    return {
+        'chapter': "Chapter 1",
+        'scene': "Scene 1",
+        'scene_summary': [f"Summary sentence {s}." for s in range(5)],
+        'npcs': {f"NPC {n}": {'kin': "Goblin", 'persona': ["Cunning."], 'goal': "Goal.", 'trait': "Trait.", 'flaw': "Flaw."} for n in range(num_npcs)},
+        'success_condition': "Success.",
+        'failure_condition': "Failure.",
+        'game_flow': [f"Flow {f}." for f in range(5)],
+        'environment': {f"Object {o}": "Description." for o in range(10)},
+        'random_tables': {f"Table {t}": [f"Entry {e} of the table {t}." for e in range(entries_per_table)] for t in range(num_tables)},
+        'consequences': "Consequences."
+    }
+
+
+# Making a manager which is only used for recording the states. The keyword arguments override the default arguments.
+def make_manager(scene: dict, num_players: int, model_idx: str='gpt-4o', **kwargs):
+    main_args = Namespace(**{
+        'concat_policy': 'simple', 'max_num_msgs': None, 'summarization': False, 'summ_period': None, 'summ_budget': None, 'clear_raw_logs': False,
+        'async_summarization': False, 'summ_merge_size': None, 'rule_injection': 'full', 'embedding_precision': 'float32', 'embedding_cache_dir': None,
+        'retrieval_index': 'exact', 'ann_threshold': 4096, 'encoder_backend': 'torch', 'encoder_threads': None, 'log_format': 'full',
+        'validation_policy': 'full', 'validation_window': None, 'state_detection': 'sequential', 'state_update_protocol': 'full',
+        **kwargs
+    })
+    engine = OpenAIEngine(api_key='benchmark', model=model_idx)  # No request is sent to the API.
+    manager = GameManager(scene=scene, main_args=main_args, engine=engine, system_prompt="")
+    for p in range(num_players):
+        manager.players.append(Player(
+            name=f"Player {p}", kin="Human", persona=["Brave."], goal="Goal.",
+            traits={"Trait": "Desc."}, flaws={"Flaw": "Desc."}, inventory={f"Item {i}": "Desc." for i in range(5)}, additional_notes=["Note."]
+        ))
+    return manager
+
+
+# The per-step times of making the contexts in microseconds. The environment is changed once every change_period steps.
+def measure(manager: GameManager, make_fn, num_steps: int, change_period: int):
+    unchanged, changed = [], []
+    for step in range(num_steps):
+        is_changed = step % change_period == 0
+        if is_changed:
+            manager.environment[f"New object {step}"] = "Description."
+            manager.mark_scene_changed('environment')
+            manager.players[0].add_item(f"New item {step}", "Description.")
+
+        start = time.perf_counter()
+        make_fn(manager)
+        elapsed = (time.perf_counter() - start) * 1e6
+        (changed if is_changed else unchanged).append(elapsed)
+    return np.median(unchanged), np.median(changed)
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_tables', type=int, nargs='+', default=[10, 100, 1000], help="The numbers of random tables in the scene.")
+    parser.add_argument('--entries_per_table', type=int, default=20, help="The number of entries in each random table.")
+    parser.add_argument('--num_npcs', type=int, default=20, help="The number of NPCs in the scene.")
+    parser.add_argument('--num_players', type=int, default=4, help="The number of players.")
+    parser.add_argument('--num_steps', type=int, default=200, help="The number of model steps to record.")
+    parser.add_argument('--change_period', type=int, default=10, help="The period of the steps where the states are changed by a function.")
+
+    args = parser.parse_args()
+
+    print(f"{'tables':>7} | {'deepcopy (us)':>14} | {'snapshot, unchanged (us)':>24} | {'snapshot, changed (us)':>22}")
+    for num_tables in args.num_tables:
+        scene = make_scene(num_tables, args.entries_per_table, args.num_npcs)
+        manager = make_manager(scene, args.num_players)
+
+        # Both should record the same states.
+        assert manager.make_context() == deepcopy_context(manager), "The snapshot is different from the deep-copied context."
+
+        deepcopy_time, _ = measure(manager, deepcopy_context, args.num_steps, args.change_period)
+        unchanged_time, changed_time = measure(manager, GameManager.make_context, args.num_steps, args.change_period)
+        print(f"{num_tables:>7} | {deepcopy_time:>14.1f} | {unchanged_time:>24.2f} | {changed_time:>22.1f}")
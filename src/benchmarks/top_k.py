@@ -0,0 +1,73 @@
+import os
+import sys
+
+cur_dir = os.path.dirname(__file__)
+src_path = os.path.abspath(os.path.join(cur_dir, '..'))
+sys.path.insert(0, src_path)
+
+from retrieval import max_pooled_top_k
+
+import argparse
+import time
+import numpy as np
+
+try:
+    import torch
+except ImportError:
+    torch = None
+
+
+# Selecting the top-k candidates with the full sorts in torch. (The previous implementation.)
+def torch_top_k(cos_sims: np.ndarray, k: int):
+    cos_sims = torch.from_numpy(cos_sims)
+    scores = torch.max(cos_sims, dim=0).values
+    idxs = torch.sort(scores, descending=True).indices[:k]
+    idxs = torch.sort(idxs).values
+    return idxs.numpy(), np.array([scores[idx].item() for idx in idxs])
+
+
+# Selecting the top-k candidates with the full sort in numpy.
+def numpy_sort_top_k(cos_sims: np.ndarray, k: int):
+    scores = cos_sims.max(axis=0)
+    idxs = np.sort(np.argsort(-scores)[:k])
+    return idxs, scores[idxs]
+
+
+# The median elapsed time of the function in milliseconds.
+def measure(fn, cos_sims: np.ndarray, k: int, num_runs: int):
+    elapsed = []
+    for _ in range(num_runs):
+        start = time.perf_counter()
+        fn(cos_sims, k)
+        elapsed.append(time.perf_counter() - start)
+    return np.median(elapsed) * 1e3
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000], help="The numbers of candidates.")
+    parser.add_argument('--num_queries', type=int, default=3, help="The number of queries.")
+    parser.add_argument('--top_n', type=int, default=20, help="The number of candidates to select.")
+    parser.add_argument('--num_runs', type=int, default=100, help="The number of runs for each size.")
+    parser.add_argument('--seed', type=int, default=0, help="The random seed.")
+
+    args = parser.parse_args()
+    rng = np.random.default_rng(args.seed)
+
+    fns = {'numpy sort': numpy_sort_top_k, 'argpartition': max_pooled_top_k}
+    if torch is not None:
+        fns = {'torch sort': torch_top_k, **fns}
+    else:
+        print("torch is not installed, so the torch path is skipped.")
+
+    print(f"{'size':>8} | " + ' | '.join(f"{name + ' (ms)':>17}" for name in fns))
+    for size in args.sizes:
+        cos_sims = rng.uniform(-1.0, 1.0, size=(args.num_queries, size)).astype('float32')
+
+        # All paths should select the same candidates in the same order.
+        ref_idxs, _ = max_pooled_top_k(cos_sims, args.top_n)
+        for name, fn in fns.items():
+            idxs, _ = fn(cos_sims, args.top_n)
+            assert np.array_equal(idxs, ref_idxs), f"The result of {name} is different from the others."
+
+        print(f"{size:>8} | " + ' | '.join(f"{measure(fn, cos_sims, args.top_n, args.num_runs):>17.4f}" for fn in fns.values()))
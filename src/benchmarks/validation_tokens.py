@@ -0,0 +1,71 @@
+import os
+import sys
+
+cur_dir = os.path.dirname(__file__)
+src_path = os.path.abspath(os.path.join(cur_dir, '..'))
+sys.path.insert(0, src_path)
+
+from gameplay_logs import decode_gameplay_logs, load_gameplay_logs
+from utils import convert_into_message
+from state_snapshot import make_manager
+
+import argparse
+import asyncio
+import numpy as np
+
+
+# Getting the raw history and the conditions at each validation point from the recorded game.
+# The validation runs after each turn, so each distinct length of the past history is one validation point.
+def get_validation_points(game_file: str):
+    points, history = [], []
+    for record in decode_gameplay_logs(load_gameplay_logs(game_file)):
+        if 'past_history' not in record:  # The game result.
+            continue
+        if len(record['past_history']) > len(history):
+            history = [convert_into_message(obj) for obj in record['past_history']]
+            points.append((len(history), record['scene']))
+    return history, points
+
+
+# The number of tokens in the chat history for each validation in the game.
+# The summary policy is estimated with summary_tokens for the summary, since it requires the model to generate the summary.
+async def count_tokens(policy: str, history: list, points: list, window: int, summary_tokens: int, model_idx: str):
+    scene = points[0][1]
+    manager = make_manager(scene, 0, model_idx=model_idx, validation_policy=policy, validation_window=None if policy == 'full' else window)
+
+    num_tokens = []
+    for num_msgs, scene in points:
+        manager.raw_history = history[:num_msgs]
+        for condition in [scene['success_condition'], scene['failure_condition']]:
+            if policy == 'summary':
+                recent = manager.raw_history[-window:]
+                num_tokens.append(sum(manager.message_token_len(message) for message in recent) + (summary_tokens if num_msgs > window else 0))
+            else:
+                valid_history = await manager.get_validation_history(condition)
+                num_tokens.append(sum(manager.message_token_len(message) for message in valid_history))
+    return np.array(num_tokens)
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--game_file', type=str, required=True, help="The path of the recorded gameplay logs. (.json or .jsonl)")
+    parser.add_argument('--model_idx', type=str, default='gpt-4o', help="The model whose tokenizer is used for counting the tokens.")
+    parser.add_argument('--validation_window', type=int, default=10, help="The number of the last messages for the window-based policies.")
+    parser.add_argument('--summary_tokens', type=int, default=300, help="The assumed number of tokens in the summary for the summary policy.")
+    parser.add_argument('--use_encoder', action='store_true', help="Also running the retrieval policy with the actual sentence encoder.")
+
+    args = parser.parse_args()
+
+    history, points = get_validation_points(args.game_file)
+    print(f"{len(points)} validation points over {len(history)} messages (2 validations each)\n")
+
+    policies = ['full', 'window', 'summary']
+    if args.use_encoder:
+        policies.append('retrieval')
+
+    print(f"{'policy':>10} | {'mean tokens':>11} | {'max tokens':>10} | {'last tokens':>11} | {'total tokens':>12}")
+    for policy in policies:
+        num_tokens = asyncio.run(count_tokens(policy, history, points, args.validation_window, args.summary_tokens, args.model_idx))
+        label = policy + ('*' if policy == 'summary' else '')
+        print(f"{label:>10} | {num_tokens.mean():>11.1f} | {num_tokens.max():>10d} | {num_tokens[-1]:>11d} | {num_tokens.sum():>12d}")
+    print("\n* The summary is counted as --summary_tokens tokens.")
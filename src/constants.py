@@ -6,6 +6,8 @@ SYSTEM_TIME_LIMIT = GAME_TIME_LIMIT + 2 * ONE_MINIUTE  # This is a time limit fo
 
 SEP = '||'
 
+SENTENCE_ENCODER = 'all-mpnet-base-v2'  # The sentence encoder for the retrieval.
+
 TASK_INTRODUCTION = [
     "<p><strong><h2>Introduction</h2></strong><br>",
     "In this task, you will see the part of the gameplay data of a text adventure game called \"Jim Henson's Labyrinth: The Adventure Game\". ",
@@ -114,6 +116,36 @@ RULE_SUMMARY = [
     ]
 ]
 
+# The test questions for evaluating the rule understanding.
+RULE_QUESTIONS = [
+    'What is the difference between a test and an action scene?',
+    'List all properties that one player character can have during the game.',
+    'What is required for evaluating if the NPC says or behaves properly during the game?',
+    'Assume that the difficulty of a test is 5. If two more players are going to help the test with their traits, what is the final difficulty value?',
+    'If the inventory of a player is full and there is an item the player wants to have. What should the player do?',
+    'What is this action scene initiated by a player different from the one by the Goblin King?',
+    "How long does an NPC stay in the player's party after it joins? Give the specific time amount.",
+    'Which amount of the overall time limit in the Labyrinth is?',
+    'Describe how the game manager can end the current scene.',
+    'How does an action is terminated?',
+    'What is the condition that the player can pass the test if the difficulty value is 3?',
+    'What is the valid range of difficulty number?',
+    'How does the Goblin King use the random tables during the game?',
+    'What is the maximum number of items that one player can hold?',
+    'If other players decide to help the one who is going to do a test, describe how the test changes depending on the traits or flaws.',
+    'What is the effect of the items in the Labyrinth?',
+    'What happens if the Goblin King does not notify the decrease of remaining time at every minute?',
+    'Assume that the difficulty of a test is 4. If three more players are going to help the test with their traits, what is the final difficulty value?',
+    'How many actions are allowed per player at each turn?',
+    'How much is the time limit for each player turn during an action scene?',
+    'What should the Goblin King do if a player tries to speak with an NPC?',
+    'If the result from a dice is 1, what is the possible difficulty range of a test the player can win?',
+    "How can we make an NPC stay in the player's group after the Goblin King appears in the scene?",
+    'What is the role of the Goblin King during an action scene?',
+    'If a player wants to talk with an NPC whose attributes have not been generated by the Goblin King before, what should the Goblin King do?',
+    'What is the difficulty of a test for checking if an NPC leaves the party?'
+]
+
 SCENE_INIT_PROMPT = [
     "You are a scene initializer in a fantasy text-based adventure game.",
     "You should generate the required content in a game scene while strictly following the form of the output if it is specified.",
@@ -223,6 +255,13 @@ SUMMARIZE_PROMPT = [
     "You should generate the summarization of the given conversation to include the essential information."
 ]
 
+FOLD_SUMMARY_PROMPT = [
+    "You are a dialogue summarizer in a fantasy text-based adventure game.",
+    "You will be given the chat history between the users (players) and an assistant (game manager).",
+    "You should generate the summarization of the given conversation to include the essential information.",
+    "If the chat history starts with a previous summarization, your summarization should cover both the previous summarization and the following messages."
+]
+
 STATE_DETECT_PROMPT = [
     "You are a state change detecter in a fantasy text-based adventure game.",
     "You will be given the current state of the game scene or a player.",
@@ -233,6 +272,19 @@ STATE_DETECT_PROMPT = [
     "You must answer only in number."
 ]
 
+STATE_BATCH_DETECT_PROMPT = [
+    "You are a state change detecter in a fantasy text-based adventure game.",
+    "You will be given the current states of the game scene and all players.",
+    "Also you will be given one interaction between the players and the game manager, which is called Goblin King, during the game.",
+    "You should determine whether each given state has been updated based on the given interaction.",
+    "The properties you have to focus on in the scene state include 'npcs', 'environment', and 'random_tables'.",
+    "The properties you have to focus on in the player state include 'traits', 'flaws', and 'inventory'.",
+    "You should answer in a JSON object which has two keys, 'scene' and 'players'.",
+    "The value of 'scene' is a boolean, and the value of 'players' is a list of booleans in the same order as the given player states.",
+    "This means that the output should not contain any data formats which violate the JSON restrictions, such as single quotation marks or caplitalized boolen value.",
+    "You should not generate any additional content or explanation and make sure that your answer can be parsed as a Python dictionary without an error."
+]
+
 STATE_UPDATE_PROMPT = [
     "You are a state updater in a fantasy text-based adventure game.",
     "You should generate the updated states strictly following the same JSON format of the input state.",
@@ -245,6 +297,22 @@ STATE_UPDATE_PROMPT = [
     "If there is nothing to update, just generate the state which is identical to the input."
 ]
 
+STATE_PATCH_PROMPT = [
+    "You are a state updater in a fantasy text-based adventure game.",
+    "You should generate only the changes of the input state as a list of operations, instead of re-generating the whole state.",
+    "Each operation is a JSON object which has three keys, 'op', 'path', and 'value'.",
+    "The value of 'op' is one of 'add', 'remove', and 'replace', and 'remove' does not need 'value'.",
+    "The value of 'path' is a JSON pointer to the changed property in the input state, such as '/inventory/Rope', '/npcs/Goblin/goal' or '/random_tables/Goblin names/0'.",
+    "To add a new element at the end of a list, use '-' as the last part of the path, such as '/random_tables/Goblin names/-'.",
+    "This should be a JSON list which can be parsed as a Python list.",
+    "This means that the output should not contain any data formats which violate the JSON restrictions, such as single quotation marks, non-string-type keys or caplitalized boolen value.",
+    "You should not generate any additional content or explanation and make sure that your answer can be parsed as a Python list without an error.",
+    "You will be given the game rules, the previous state and one interaction between the players and the game manager, which is called Goblin King, during the game.",
+    "This interaction might have multiple responses from the game manager or the results of function calls.",
+    "Carefully consider what changes have happened during the interaction and generate the operations for them.",
+    "If there is nothing to update, just generate an empty list."
+]
+
 DIFFICULTY_PROMPT = [
     "You are a ternary classifier in a fantasy text-based adventure game.",
     "You will be given the current state of the player character which includes his/her traits, flaws and inventory.",
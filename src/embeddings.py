@@ -0,0 +1,382 @@
+from typing import Tuple, Callable
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+
+import os
+import json
+import hashlib
+import threading
+import asyncio
+import numpy as np
+
+PRECISIONS = ['float64', 'float32', 'int8']
+ENCODER_BACKENDS = ['torch', 'quantized']
+
+
+# Normalizing the embeddings so that the cosine similarity is just a dot product.
+def normalize_embeddings(embs: np.ndarray, dtype: str='float32') -> np.ndarray:
+    embs = np.asarray(embs, dtype=dtype)
+    norms = np.linalg.norm(embs, axis=-1, keepdims=True)
+    return embs / np.maximum(norms, 1e-12)
+
+
+# Quantizing the normalized embeddings into int8 with the per-vector scales.
+def quantize_embeddings(embs: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    scales = np.maximum(np.abs(embs).max(axis=-1), 1e-12) / 127.0
+    codes = np.clip(np.rint(embs / scales[:, None]), -127, 127).astype('int8')
+    return codes, scales.astype('float32')
+
+
+# The growable embedding matrix for the retrieval.
+# The allocated capacity is doubled when it is full, so appending is O(1) amortized.
+# The embeddings are normalized before being stored, and stored in the given precision.
+# If the dimension is not given, it is set when the first embeddings are added.
+class EmbeddingBuffer():
+    def __init__(self, dim: int=None, capacity: int=64, precision: str='float32'):
+        assert precision in PRECISIONS, f"The embedding precision should be one of {PRECISIONS}."
+        self.precision = precision
+        self.data = np.empty((capacity, dim if dim is not None else 0), dtype=precision)
+        self.scales = np.empty(capacity, dtype='float32') if precision == 'int8' else None
+        self.length = 0  # The logical number of embeddings.
+
+    def __len__(self):
+        return self.length
+
+    # Wrapping the pre-computed arrays without copying them. (e.g. memory-mapped files)
+    @classmethod
+    def from_arrays(cls, data: np.ndarray, scales: np.ndarray=None):
+        buffer = cls.__new__(cls)
+        buffer.precision = data.dtype.name
+        buffer.data = data
+        buffer.scales = scales
+        buffer.length = data.shape[0]
+        return buffer
+
+    @property
+    def shape(self):
+        return (self.length, self.data.shape[1])
+
+    # The number of bytes which are actually used by the valid embeddings.
+    @property
+    def nbytes(self):
+        nbytes = self.length * self.data.shape[1] * self.data.itemsize
+        if self.scales is not None:
+            nbytes += self.length * self.scales.itemsize
+        return nbytes
+
+    # The valid embeddings without copying. (The quantized codes if precision=int8.)
+    def view(self) -> np.ndarray:
+        return self.data[:self.length]
+
+    # Reallocating the matrix if the capacity is not enough.
+    def reserve(self, capacity: int):
+        if capacity <= self.data.shape[0]:
+            return
+        new_capacity = max(self.data.shape[0], 1)
+        while new_capacity < capacity:
+            new_capacity *= 2
+        new_data = np.empty((new_capacity, self.data.shape[1]), dtype=self.data.dtype)
+        new_data[:self.length] = self.data[:self.length]
+        self.data = new_data
+        if self.scales is not None:
+            new_scales = np.empty(new_capacity, dtype=self.scales.dtype)
+            new_scales[:self.length] = self.scales[:self.length]
+            self.scales = new_scales
+
+    # Adding the new embeddings at the end.
+    def append(self, embs: np.ndarray):
+        if self.length == 0 and self.data.shape[1] == 0:
+            self.data = np.empty((self.data.shape[0], embs.shape[1]), dtype=self.data.dtype)
+        assert embs.ndim == 2 and embs.shape[1] == self.data.shape[1], "The dimension of the new embeddings is not matched with the buffer."
+        self.reserve(self.length + embs.shape[0])
+        start, end = self.length, self.length + embs.shape[0]
+        if self.precision == 'int8':
+            self.data[start:end], self.scales[start:end] = quantize_embeddings(normalize_embeddings(embs))
+        else:
+            self.data[start:end] = normalize_embeddings(embs, dtype=self.precision)
+        self.length = end
+
+    # Inserting the new embeddings at the given index by shifting the rest in place.
+    def insert(self, idx: int, embs: np.ndarray):
+        assert 0 <= idx <= self.length, "The index to insert is out of the buffer."
+        num_left, num_new = self.length - idx, embs.shape[0]
+        self.append(embs)  # Reserving the space and normalizing the new embeddings.
+        if num_left == 0:
+            return
+
+        new_data = self.data[self.length-num_new:self.length].copy()
+        self.data[idx+num_new:self.length] = self.data[idx:idx+num_left]
+        self.data[idx:idx+num_new] = new_data
+        if self.scales is not None:
+            new_scales = self.scales[self.length-num_new:self.length].copy()
+            self.scales[idx+num_new:self.length] = self.scales[idx:idx+num_left]
+            self.scales[idx:idx+num_new] = new_scales
+
+    # Removing the embeddings in [start, end) by shifting the rest in place.
+    def delete(self, start: int, end: int):
+        assert 0 <= start <= end <= self.length, "The range to delete is out of the buffer."
+        num_left = self.length - end
+        self.data[start:start+num_left] = self.data[end:self.length]
+        if self.scales is not None:
+            self.scales[start:start+num_left] = self.scales[end:self.length]
+        self.length -= (end - start)
+
+    # The normalized float32 embeddings. (The int8 codes are de-quantized.)
+    def dequantize(self, idxs: np.ndarray=None) -> np.ndarray:
+        data = self.view() if idxs is None else self.data[idxs]
+        if self.precision != 'int8':
+            return data.astype('float32', copy=False)
+        scales = self.scales[:self.length] if idxs is None else self.scales[idxs]
+        return data.astype('float32') * scales[:, None]
+
+    # Calculating the cosine similarities between the queries and the stored embeddings.
+    # If the indices are given, only the selected embeddings are compared.
+    def similarity(self, query_embs: np.ndarray, idxs: np.ndarray=None, chunk_size: int=4096) -> np.ndarray:
+        data = self.view() if idxs is None else self.data[idxs]
+        if self.precision != 'int8':
+            return normalize_embeddings(query_embs, dtype=self.precision) @ data.T  # (Q, N)
+
+        # The int8 codes are de-quantized chunk by chunk to bound the temporary memory.
+        scales = self.scales[:self.length] if idxs is None else self.scales[idxs]
+        query_embs = normalize_embeddings(query_embs)
+        sims = np.empty((query_embs.shape[0], data.shape[0]), dtype='float32')
+        for start in range(0, data.shape[0], chunk_size):
+            end = min(start + chunk_size, data.shape[0])
+            sims[:, start:end] = (query_embs @ data[start:end].T.astype('float32')) * scales[start:end]
+        return sims  # (Q, N)
+
+
+# The worker which runs the encoding on a bounded thread pool so that the event loop is not blocked.
+# The requests made in the same iteration of the event loop are micro-batched into one encode call.
+class EncodingWorker():
+    def __init__(self, encode_fn: Callable, max_workers: int=1, max_batch_size: int=256):
+        self.encode_fn = encode_fn
+        self.max_batch_size = max_batch_size
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='encoder')
+        self.pending = []  # The pairs of (contents, future) which are waiting for the next batch.
+        self.num_requests = 0
+        self.num_calls = 0
+
+    # Requesting the embeddings of the texts. This is resolved when the batch which includes them is finished.
+    async def encode(self, contents: list[str]) -> np.ndarray:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((contents, future))
+        self.num_requests += 1
+        if len(self.pending) == 1:
+            loop.call_soon(self.flush, loop)
+        return await future
+
+    # Sending the pending requests to the thread pool as the batches.
+    def flush(self, loop: asyncio.AbstractEventLoop):
+        pending, self.pending = self.pending, []
+        batch, batch_size = [], 0
+        for contents, future in pending:
+            if len(batch) > 0 and batch_size + len(contents) > self.max_batch_size:
+                self.submit(loop, batch)
+                batch, batch_size = [], 0
+            batch.append((contents, future))
+            batch_size += len(contents)
+        if len(batch) > 0:
+            self.submit(loop, batch)
+
+    def submit(self, loop: asyncio.AbstractEventLoop, batch: list):
+        self.num_calls += 1
+        task = loop.run_in_executor(self.executor, self.encode_fn, list(chain.from_iterable(contents for contents, _ in batch)))
+        task.add_done_callback(lambda task: self.dispatch(task, batch))
+
+    # Splitting the result of one batch back into each request.
+    @staticmethod
+    def dispatch(task: asyncio.Future, batch: list):
+        start = 0
+        for contents, future in batch:
+            if future.done():  # The request has been cancelled.
+                pass
+            elif task.cancelled():
+                future.cancel()
+            elif task.exception() is not None:
+                future.set_exception(task.exception())
+            else:
+                future.set_result(task.result()[start:start+len(contents)])
+            start += len(contents)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+
+# The sentence encoder shared in the whole process. The model is loaded on the first use.
+# backend=quantized: The linear layers are dynamically quantized into int8 for the faster inference on CPU.
+class SharedEncoder():
+    def __init__(self, name: str, backend: str='torch', num_threads: int=None):
+        assert backend in ENCODER_BACKENDS, f"The encoder backend should be one of {ENCODER_BACKENDS}."
+        self.name = name
+        self.backend = backend
+        self.num_threads = num_threads
+        self.model = None
+        self.worker = None
+        self.lock = threading.Lock()  # The model can be loaded from the worker thread.
+
+    # The identifier of the embeddings, which is used as the key of the on-disk cache.
+    @property
+    def key(self):
+        return self.name if self.backend == 'torch' else f"{self.name}-{self.backend}"
+
+    def load(self):
+        with self.lock:
+            if self.model is None:
+                import torch
+                from sentence_transformers import SentenceTransformer
+                if self.num_threads is not None:
+                    torch.set_num_threads(self.num_threads)
+
+                if self.backend == 'quantized':  # The dynamic quantization is only supported on CPU.
+                    model = SentenceTransformer(self.name, device='cpu')
+                    self.model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+                else:
+                    device = torch.device('cuda:0') if torch.cuda.is_available() else torch.device('cpu')
+                    self.model = SentenceTransformer(self.name).to(device)
+        return self.model
+
+    def encode(self, contents: list[str], **kwargs) -> np.ndarray:
+        return self.load().encode(contents, **kwargs)
+
+    # Encoding the texts on the worker thread without blocking the event loop.
+    async def encode_async(self, contents: list[str]) -> np.ndarray:
+        if self.worker is None:
+            self.worker = EncodingWorker(self.encode)
+        return await self.worker.encode(contents)
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.load().get_sentence_embedding_dimension()
+
+    # Freeing the loaded model.
+    def release(self):
+        if self.worker is not None:
+            self.worker.close()
+            self.worker = None
+        if self.model is not None:
+            self.model = None
+            import torch
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+
+
+ENCODERS = {}
+
+
+# Getting the shared encoder from the registry.
+# The number of threads is set for the whole process when the model is loaded, so it should be the same as the cached encoder.
+def get_encoder(name: str, backend: str='torch', num_threads: int=None) -> SharedEncoder:
+    if (name, backend) not in ENCODERS:
+        ENCODERS[(name, backend)] = SharedEncoder(name, backend, num_threads)
+    encoder = ENCODERS[(name, backend)]
+    assert encoder.num_threads == num_threads, f"The encoder {name} has already been created with {encoder.num_threads} threads, not {num_threads}."
+    return encoder
+
+
+# Releasing all encoders in the registry. This should be called when the encoders are not needed anymore.
+def release_encoders():
+    for encoder in ENCODERS.values():
+        encoder.release()
+    ENCODERS.clear()
+
+
+# Saving an array atomically so that a partially written file is never loaded.
+def save_array(path: str, arr: np.ndarray):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        np.save(f, arr)
+    os.replace(tmp_path, path)
+
+
+# Loading the rule embeddings from the on-disk cache, or encoding and caching them if they do not exist.
+# The key includes the rule texts, so the cache is invalidated automatically when the rules are changed.
+def load_rule_embeddings(rules: list[str], encoder_name: str, precision: str, encode_fn: Callable, cache_dir: str) -> EmbeddingBuffer:
+    key = hashlib.sha256(json.dumps([rules, encoder_name, precision]).encode('utf-8')).hexdigest()
+    data_path, scales_path = f"{cache_dir}/rules-{key}.npy", f"{cache_dir}/rules-{key}.scales.npy"
+
+    # The cached embeddings are memory-mapped.
+    if os.path.isfile(data_path) and (precision != 'int8' or os.path.isfile(scales_path)):
+        data = np.load(data_path, mmap_mode='r')
+        scales = np.load(scales_path, mmap_mode='r') if precision == 'int8' else None
+        if data.shape[0] == len(rules):
+            return EmbeddingBuffer.from_arrays(data, scales)
+
+    embs = encode_fn(rules)
+    rule_embs = EmbeddingBuffer(embs.shape[1], capacity=len(rules), precision=precision)
+    rule_embs.append(embs)
+
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+    save_array(data_path, rule_embs.view())
+    if precision == 'int8':
+        save_array(scales_path, rule_embs.scales[:len(rule_embs)])
+
+    return rule_embs
+
+
+# The embedding cache keyed by the content hash of each text with LRU eviction.
+# The same message is encoded only once even if it is retrieved or stored multiple times.
+class EmbeddingCache():
+    def __init__(self, encoder, max_size: int=4096):
+        self.encoder = encoder
+        self.max_size = max_size
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.cache)
+
+    # The hit/miss counters.
+    def get_stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.cache)}
+
+    # Finding the texts which are not in the cache.
+    def lookup(self, contents: list[str]):
+        keys = [hashlib.sha1(content.encode('utf-8')).digest() for content in contents]
+
+        found, missing = {}, {}
+        for key, content in zip(keys, contents):
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                found[key] = self.cache[key]
+                self.hits += 1
+            elif key not in missing:
+                missing[key] = content
+                self.misses += 1
+            else:
+                self.hits += 1  # The duplicate in the same batch is encoded only once.
+
+        return keys, found, missing
+
+    # Storing the newly encoded embeddings and gathering the results in the original order.
+    # The hit embeddings are taken at the lookup, since they might be evicted by another request while encoding.
+    def fill(self, keys: list[bytes], found: dict, missing: dict, new_embs: np.ndarray) -> np.ndarray:
+        if len(missing) > 0:
+            for key, emb in zip(missing.keys(), new_embs):
+                found[key] = emb
+                self.cache[key] = emb
+
+        res = [found[key] for key in keys]
+
+        # Evicting the least recently used embeddings.
+        while len(self.cache) > self.max_size:
+            self.cache.popitem(last=False)
+
+        if len(res) == 0:
+            return np.empty((0, self.encoder.get_sentence_embedding_dimension()), dtype='float32')
+        return np.stack(res)  # (N, d)
+
+    # Encoding the texts while only passing the missing ones to the encoder.
+    def encode(self, contents: list[str]) -> np.ndarray:
+        keys, found, missing = self.lookup(contents)
+        new_embs = self.encoder.encode(list(missing.values())) if len(missing) > 0 else None
+        return self.fill(keys, found, missing, new_embs)
+
+    # Same as encode(), but the missing texts are encoded on the worker thread of the encoder.
+    async def encode_async(self, contents: list[str]) -> np.ndarray:
+        keys, found, missing = self.lookup(contents)
+        new_embs = await self.encoder.encode_async(list(missing.values())) if len(missing) > 0 else None
+        return self.fill(keys, found, missing, new_embs)
@@ -10,9 +10,9 @@ from kani.engines.openai import OpenAIEngine
 from agents.manager import GameManager
 from agents.evaluator import Evaluator
 from utils import convert_into_class_idx, print_question_start, print_system_log
-from constants import ASSISTANT_INSTRUCTION
+from constants import ASSISTANT_INSTRUCTION, RULE_QUESTIONS
 from utils import log_break, get_player_input
-from sentence_transformers import SentenceTransformer
+from embeddings import release_encoders
 from argparse import Namespace
 from datetime import datetime
 from pytz import timezone
@@ -21,7 +21,6 @@ import asyncio
 import argparse
 import json
 import logging
-import torch
 import numpy as np
 import random
 
@@ -100,34 +99,7 @@ def evaluate_scene_init(args: Namespace, engine: OpenAIEngine):
 # Evaluating the rule understanding capability of a model.
 def evaluate_rules(args: Namespace, target_model: Kani, engine: OpenAIEngine):
     # The list of test questions.
-    questions = [
-        'What is the difference between a test and an action scene?',
-        'List all properties that one player character can have during the game.',
-        'What is required for evaluating if the NPC says or behaves properly during the game?',
-        'Assume that the difficulty of a test is 5. If two more players are going to help the test with their traits, what is the final difficulty value?',
-        'If the inventory of a player is full and there is an item the player wants to have. What should the player do?',
-        'What is this action scene initiated by a player different from the one by the Goblin King?',
-        "How long does an NPC stay in the player's party after it joins? Give the specific time amount.",
-        'Which amount of the overall time limit in the Labyrinth is?',
-        'Describe how the game manager can end the current scene.',
-        'How does an action is terminated?',
-        'What is the condition that the player can pass the test if the difficulty value is 3?',
-        'What is the valid range of difficulty number?',
-        'How does the Goblin King use the random tables during the game?',
-        'What is the maximum number of items that one player can hold?',
-        'If other players decide to help the one who is going to do a test, describe how the test changes depending on the traits or flaws.',
-        'What is the effect of the items in the Labyrinth?',
-        'What happens if the Goblin King does not notify the decrease of remaining time at every minute?',
-        'Assume that the difficulty of a test is 4. If three more players are going to help the test with their traits, what is the final difficulty value?',
-        'How many actions are allowed per player at each turn?',
-        'How much is the time limit for each player turn during an action scene?',
-        'What should the Goblin King do if a player tries to speak with an NPC?',
-        'If the result from a dice is 1, what is the possible difficulty range of a test the player can win?',
-        "How can we make an NPC stay in the player's group after the Goblin King appears in the scene?",
-        'What is the role of the Goblin King during an action scene?',
-        'If a player wants to talk with an NPC whose attributes have not been generated by the Goblin King before, what should the Goblin King do?',
-        'What is the difficulty of a test for checking if an NPC leaves the party?'
-    ]
+    questions = list(RULE_QUESTIONS)
     random.seed(args.seed)
     random.shuffle(questions)
 
@@ -206,6 +178,10 @@ if __name__=='__main__':
     parser.add_argument('--seed', type=int, default=0, help="The random seed for shuffling the question list.")
     parser.add_argument('--target_model_idx', type=str, help="The index of the model which should be evaluated.")
     parser.add_argument('--rule_injection', type=str, default='full', help="The rule injection policy.")
+    parser.add_argument('--embedding_precision', type=str, default='float32', help="The precision of the stored rule embeddings for the retrieval.")
+    parser.add_argument('--embedding_cache_dir', type=str, default=".cache/embeddings", help="The directory of the on-disk cache of the rule embeddings.")
+    parser.add_argument('--encoder_backend', type=str, default='torch', help="The backend of the sentence encoder for the retrieval.")
+    parser.add_argument('--encoder_threads', type=int, help="The number of CPU threads for the sentence encoder.")
 
     args = parser.parse_args()
 
@@ -221,28 +197,30 @@ if __name__=='__main__':
         assert args.scene_path is not None, "You should specify the initialized scene data you want to evaluate."
     if args.eval_task == 'rules':
         assert args.target_model_idx is not None, "You should specify the model you want to test."
-        assert args.rule_injection in ['full', 'retrieval'], "Specify an available rule injection option: 'full' / 'retrieval'"
-
-        # Setting the sentence encoder for the rule embedding.
-        encoder = None
-        if args.rule_injection == 'retrieval':
-            print("Setting a sentence encoder for retrieval...")
-            device = torch.device('cuda:0') if torch.cuda.is_available() else torch.device('cpu')
-            encoder = SentenceTransformer('all-mpnet-base-v2').to(device)
+        assert args.rule_injection in ['full', 'retrieval', 'hybrid', 'lexical'], "Specify an available rule injection option: 'full' / 'retrieval' / 'hybrid' / 'lexical'"
+        assert args.embedding_precision in ['float64', 'float32', 'int8'], "Specify an available embedding precision: 'float64' / 'float32' / 'int8'"
+        assert args.encoder_backend in ['torch', 'quantized'], "Specify an available encoder backend: 'torch' / 'quantized'"
 
         args.concat_policy = 'simple'
         args.max_num_msgs = None
         args.summarization = False
         args.summ_period = None
+        args.summ_budget = None
         args.clear_raw_logs = False
+        args.async_summarization = False
+        args.summ_merge_size = None
+        args.validation_policy = 'full'
+        args.validation_window = None
+        args.state_detection = 'sequential'
+        args.state_update_protocol = 'full'
         args.automated_player = False
+        args.log_format = 'full'
 
         # Initializing the target game manager.
         system_prompt = ' '.join(ASSISTANT_INSTRUCTION)
         target_engine = OpenAIEngine(api_key, model=args.target_model_idx)
         target_model = GameManager(
             main_args=args,
-            encoder=encoder,
             engine=target_engine, 
             system_prompt=system_prompt
         )
@@ -253,3 +231,4 @@ if __name__=='__main__':
 
     if args.eval_task == 'rules':
         evaluate_rules(args, target_model, engine)
+        release_encoders()
@@ -10,6 +10,8 @@ from kani import Kani
 from kani.engines.openai import OpenAIEngine
 from kani.models import ChatMessage
 from copy import deepcopy
+from itertools import chain
+from typing import Iterable
 from tqdm import tqdm
 from constants import (
     EVALUATOR_INSTRUCTION,
@@ -28,6 +30,7 @@ from utils import (
     convert_into_message,
     convert_into_number
 )
+from gameplay_logs import decode_gameplay_logs, load_gameplay_logs, get_log_name
 
 import json
 import argparse
@@ -39,12 +42,16 @@ MAX_NUM_TARGETS = 10
 
 
 # Filtering only the target responses.
-def extract_target_response(data):
+def extract_target_response(data, max_num_targets: int=None):
     target_objs = []
-    for gen in data[:-1]:
+    for gen in data:
+        if 'generated' not in gen:  # The game result.
+            continue
         generated = gen['generated']
         if generated['content'] is not None:
             target_objs.append(gen)
+        if max_num_targets is not None and len(target_objs) == max_num_targets:
+            break
     return target_objs
 
 
@@ -76,9 +83,12 @@ def convert_rubric_into_queries(rubric: dict):
 
 
 # Main evaluation logic.
-def evaluate(engine: OpenAIEngine, data: dict):
-    initial_scene_state, initial_player_states = data[0]['scene'], data[0]['players']
-    target_objs = extract_target_response(data)[:MAX_NUM_TARGETS]
+def evaluate(engine: OpenAIEngine, data: Iterable[dict]):
+    # The full contexts are rebuilt one by one, so the delta logs are not expanded entirely in memory.
+    records = decode_gameplay_logs(data)
+    initial_obj = next(records)
+    initial_scene_state, initial_player_states = initial_obj['scene'], initial_obj['players']
+    target_objs = extract_target_response(chain([initial_obj], records), MAX_NUM_TARGETS)
     consistency_query1, consistency_query2 = convert_rubric_into_queries(CONSISTENCY_RUBRIC)
     reliability_query1, reliability_query2 = convert_rubric_into_queries(RELIABILITY_RUBRIC)
     interest_query1, interest_query2 = convert_rubric_into_queries(INTERESTINGNESS_RUBRIC)
@@ -184,8 +194,7 @@ if __name__=='__main__':
     username = get_player_input(after_break=True)
 
     # Loading the gameplay data file.
-    with open(args.game_file, 'r') as f:
-        data = json.load(f)
+    data = load_gameplay_logs(args.game_file)  # The records are read incrementally.
 
     # Creating the evaluator enigne.
     api_key = input("Enter the API key for OpenAI API: ")
@@ -197,7 +206,7 @@ if __name__=='__main__':
     scored = evaluate(engine, data)
 
     # Export the scored data.
-    game_file_dir, file_name = '/'.join(args.game_file.split('/')[1:-1]), args.game_file.split('/')[-1].replace('.json', '')
+    game_file_dir, file_name = '/'.join(args.game_file.split('/')[1:-1]), get_log_name(args.game_file)
     evaluation_file_dir = f"evaluated_by_{username}/eval_model={args.model_idx}/{game_file_dir}"
     if not os.path.isdir(evaluation_file_dir):
         os.makedirs(evaluation_file_dir)
@@ -17,33 +17,42 @@ from utils import (
     convert_player_to_html,
     clean_logs
 )
+from gameplay_logs import decode_gameplay_logs, load_gameplay_logs, get_log_name
+from itertools import chain
+from typing import Iterable
 
 import argparse
-import json
 
 
 # Generating .txt file to import the Qualtrics survey.
-def generate_survey(data: list[dict]):
+def generate_survey(data: Iterable[dict]):
     survey = ["[[AdvancedFormat]]"]
 
-    initial_scene_state, initial_player_states = data[0]['scene'], data[0]['players']
+    # The full contexts are rebuilt one by one, so the delta logs are not expanded entirely in memory.
+    records = decode_gameplay_logs(data)
+    initial_obj = next(records)
+    initial_scene_state, initial_player_states = initial_obj['scene'], initial_obj['players']
     survey.append("[[Question:DB]]")
     introduction = ''.join(TASK_INTRODUCTION)
     survey.append(introduction)
     survey.append("")
 
     def extract_target_response(data):
-        target_objs = []
-        for gen in data[:-1]:
+        for gen in data:
+            if 'generated' not in gen:  # The game result.
+                continue
             generated = gen['generated']
             if generated['content'] is not None:
-                target_objs.append(gen)
-        return target_objs
+                yield gen
 
-    target_objs = extract_target_response(data)
+    target_objs = extract_target_response(chain([initial_obj], records))
 
     # Processing the targets.
     for o, obj in enumerate(target_objs):
+        # Next page for next target.
+        if o > 0:
+            survey.append("[[PageBreak]]")
+
         past_history, current_queries, generated = obj['past_history'], obj['current_queries'], obj['generated']
         
         # Combining the current queries into the past chat history.
@@ -151,10 +160,6 @@ def generate_survey(data: list[dict]):
         survey.append("Give us a comment that explains why you gave that score.")
         survey.append("")
 
-        # Next page for next target.
-        if o < len(target_objs)-1:
-            survey.append("[[PageBreak]]")
-
     return survey    
 
 
@@ -167,8 +172,7 @@ if __name__=='__main__':
     args = parser.parse_args()
 
     # Loading the data.
-    with open(args.game_file, 'r') as f:
-        data = json.load(f)
+    data = load_gameplay_logs(args.game_file)  # The records are read incrementally.
 
     # One element per one text line in .txt file.
     lines = generate_survey(data)
@@ -177,7 +181,7 @@ if __name__=='__main__':
     # Exporting the data.
     file_dir = args.game_file.split('/')[1:-1]
     file_dir = "surveys/" + '/'.join(file_dir)
-    file_name = args.game_file.split('/')[-1][:-5]
+    file_name = get_log_name(args.game_file)
     if not os.path.isdir(file_dir):
         os.makedirs(file_dir)
     with open(f"{file_dir}/{file_name}.txt", 'w') as f:
@@ -14,11 +14,11 @@ from utils import print_system_log, log_break, convert_into_message, convert_int
 from constants import ASSISTANT_INSTRUCTION
 from agents.manager import GameManager
 from agents.player import Player
+from embeddings import release_encoders
 
 import argparse
 import json
 import asyncio
-import torch
 import time
 
 
@@ -180,6 +180,7 @@ async def test(args: Namespace, engine: OpenAIEngine, unit_test: dict):
             if gen_count == 10:
                 break
     except:
+        await manager.finish()
         updated_dialogue = deepcopy(manager.current_queries)
         return {
             'score': 0,
@@ -190,14 +191,11 @@ async def test(args: Namespace, engine: OpenAIEngine, unit_test: dict):
             'updated': updated
         }
     
+    await manager.finish()
     updated_dialogue = deepcopy(manager.current_queries)
     pred_states = manager.make_context()
     res = get_score(updated, pred_states, output_states)
 
-    # Freeing memory.
-    del manager.encoder
-    torch.cuda.empty_cache()
-
     return {
         'score': res,
         'input': unit_test['input'],
@@ -224,7 +222,18 @@ if __name__=='__main__':
     parser.add_argument('--max_num_msgs', type=int, help="The maximum number of messages to be included in the prompt as chat history.")
     parser.add_argument('--summarization', action='store_true', help="Setting whether to include the summarization or not.")
     parser.add_argument('--summ_period', type=int, help="The summarization period in terms of the number of turns.")
+    parser.add_argument('--summ_budget', type=float, help="The fraction of the context window which the chat logs since the last summarization can use before being summarized.")
     parser.add_argument('--clear_raw_logs', action='store_true', help="Setting whether to remove the raw chat logs after the summarization.")
+    parser.add_argument('--async_summarization', action='store_true', help="Setting whether to run the periodic summarization in the background.")
+    parser.add_argument('--summ_merge_size', type=int, help="The number of summaries in the same level which are merged into a higher-level summary.")
+    parser.add_argument('--embedding_precision', type=str, default='float32', help="The precision of the stored sentence embeddings for the retrieval.")
+    parser.add_argument('--embedding_cache_dir', type=str, default=".cache/embeddings", help="The directory of the on-disk cache of the rule embeddings.")
+    parser.add_argument('--encoder_backend', type=str, default='torch', help="The backend of the sentence encoder for the retrieval.")
+    parser.add_argument('--encoder_threads', type=int, help="The number of CPU threads for the sentence encoder.")
+    parser.add_argument('--retrieval_index', type=str, default='exact', help="The index for the retrieval concatenation.")
+    parser.add_argument('--ann_threshold', type=int, default=4096, help="The number of messages from which the IVF index starts the approximate search.")
+    parser.add_argument('--validation_policy', type=str, default='full', help="The policy of the chat history for validating the success/failure conditions.")
+    parser.add_argument('--validation_window', type=int, help="The number of the last messages which are always included for the validation.")
 
     # Parameters for toggling the additional contexts.
     parser.add_argument('--include_functions', action='store_true', help="Setting whether to use function calls or not.")
@@ -232,6 +241,8 @@ if __name__=='__main__':
     parser.add_argument('--include_scene_state', action='store_true', help="Setting whether to include the state of the current scene.")
     parser.add_argument('--include_player_states', action='store_true', help="Setting whether to include the states of the players.")
     parser.add_argument('--generate_states', action='store_true', help="Setting whether to use a model to directly generate the scene/player states.")
+    parser.add_argument('--state_detection', type=str, default='sequential', help="The way of detecting the state changes when generate_states is set.")
+    parser.add_argument('--state_update_protocol', type=str, default='full', help="The way of updating the changed states when generate_states is set.")
 
     # Parameters for the response generation.
     parser.add_argument('--max_tokens', type=int, help="The maximum number of tokens to generate.")
@@ -242,20 +253,43 @@ if __name__=='__main__':
 
     args = parser.parse_args()
 
-    assert args.rule_injection in ['full', 'retrieval'], "Specify an available rule injection option: 'full' / 'retrieval', or leave it as non-specified."
+    assert args.rule_injection in ['full', 'retrieval', 'hybrid', 'lexical'], "Specify an available rule injection option: 'full' / 'retrieval' / 'hybrid' / 'lexical', or leave it as non-specified."
+    assert args.embedding_precision in ['float64', 'float32', 'int8'], "Specify an available embedding precision: 'float64' / 'float32' / 'int8', or leave it as non-specified."
+    assert args.encoder_backend in ['torch', 'quantized'], "Specify an available encoder backend: 'torch' / 'quantized', or leave it as non-specified."
+    assert args.validation_policy in ['full', 'window', 'retrieval', 'summary'], "Specify an available validation policy: 'full' / 'window' / 'retrieval' / 'summary', or leave it as non-specified."
+    if args.validation_policy == 'full':
+        assert args.validation_window is None, "To use validation_window, you must set validation_policy other than 'full'."
+    else:
+        assert args.validation_window is not None and args.validation_window > 0, "To use the validation policy other than 'full', you must set validation_window to a positive integer."
     if not args.summarization:
         assert args.summ_period is None, "To use summ_period, you must set the summarization argument."
+        assert args.summ_budget is None, "To use summ_budget, you must set the summarization argument."
         assert args.clear_raw_logs is False, "To use clear_raw_logs, you must set the summarization argument."
-    if args.summarization and args.summ_period is None:
+        assert args.async_summarization is False, "To use async_summarization, you must set the summarization argument."
+        assert args.summ_merge_size is None, "To use summ_merge_size, you must set the summarization argument."
+    if args.summ_budget is not None:
+        assert 0.0 < args.summ_budget < 1.0, "summ_budget should be between 0.0 and 1.0."
+    if args.summ_merge_size is not None:
+        assert args.summ_merge_size >= 2, "summ_merge_size should be at least 2."
+    if args.summarization and args.summ_period is None and args.summ_budget is None:
+        assert args.async_summarization is False, "To use async_summarization, you must set summ_period or summ_budget."
+        assert args.summ_merge_size is None, "To use summ_merge_size, you must set summ_period or summ_budget."
         print_system_log("SUMMARIZATION WITHOUT PERIOD WILL IGNORE ALL OTHER SETTINGS FOR PROMPT. THE WHOLE CHAT LOGS WILL BE SUMMARIZED INTO A PROMPT.")
     else:
         assert args.concat_policy in ['simple', 'retrieval'], "The concatenation policy should be either 'simple' or 'retrieval'."
+        assert args.retrieval_index in ['exact', 'ivf'], "Specify an available retrieval index: 'exact' / 'ivf', or leave it as non-specified."
         if args.max_num_msgs is None:
             print_system_log("ANY CONCATENATION POLICY WITH NO SPECIFIC MAX NUMBER OF MESSAGES WOULD BE CASTED INTO THE SIMPLE CONCATENATION.")
             args.concat_policy = 'simple'  # The retrieval concatenation without any number of turns is not different from the simple concatenation.
+    assert args.state_detection in ['sequential', 'batched'], "Specify an available state detection: 'sequential' / 'batched', or leave it as non-specified."
+    assert args.state_update_protocol in ['full', 'patch'], "Specify an available state update protocol: 'full' / 'patch', or leave it as non-specified."
     if args.generate_states:
         print_system_log("YOU SET update_state=True WHICH AUTOMATICALLY TURNS OFF include_functions.")
         args.include_functions = False
+    else:
+        assert args.state_detection == 'sequential', "To use the batched state detection, you must set the generate_states argument."
+        assert args.state_update_protocol == 'full', "To use the patch-based state update, you must set the generate_states argument."
+    args.log_format = 'full'  # The gameplay logs are not exported during the unit tests.
 
     api_key = input("Enter the API key for OpenAI API: ")
     os.environ['OPENAI_API_KEY'] = api_key
@@ -280,6 +314,7 @@ if __name__=='__main__':
             time.sleep(30)
 
         await engine.close()
+        release_encoders()  # The sentence encoder is shared by all tests, so it is freed only once at the end.
 
         # Exporting the result.
         if not os.path.isdir(args.result_dir):
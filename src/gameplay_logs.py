@@ -0,0 +1,191 @@
+from kani.models import ChatMessage
+from utils import convert_into_dict
+from copy import deepcopy
+
+import json
+import gzip
+import logging
+
+log = logging.getLogger("kani")
+
+
+# The encoder which converts each gameplay context into a delta record.
+# Each message/prompt text is stored only once and later records point to them with offsets and indices.
+class DeltaLogEncoder():
+    def __init__(self):
+        self.history_len = 0  # The number of past history messages which have already been logged.
+        self.prev_queries = []  # The current queries which were logged in the previous record.
+        self.text_idxs = {}  # The text pool for the actual prompts.
+        self.prev_scene = None
+        self.prev_players = []
+
+    # Getting the changed fields of a state compared to the previous one.
+    def get_state_diff(self, prev: dict, cur: dict):
+        if prev is None:
+            return cur
+        if prev is cur:  # The unchanged states share the same snapshot.
+            return {}
+        return {k: v for k, v in cur.items() if k not in prev or (prev[k] is not v and prev[k] != v)}
+
+    # Converting a full context into a delta record.
+    def encode(self, context: dict, raw_history: list[ChatMessage], current_queries: list[ChatMessage], prompt: list[str]):
+        record = {}
+
+        # The state diffs.
+        record['scene_diff'] = self.get_state_diff(self.prev_scene, context['scene'])
+        players_diff = {}
+        for p, player in enumerate(context['players']):
+            prev_player = self.prev_players[p] if p < len(self.prev_players) else None
+            diff = self.get_state_diff(prev_player, player)
+            if len(diff) > 0:
+                players_diff[p] = diff
+        record['players_diff'] = players_diff
+        record['num_players'] = len(context['players'])
+        self.prev_scene, self.prev_players = context['scene'], context['players']
+
+        # The past history is append-only, so only the newly added messages are stored.
+        record['history_offset'] = len(raw_history)
+        record['new_history'] = [convert_into_dict(msg) for msg in raw_history[self.history_len:]]
+        self.history_len = len(raw_history)
+
+        # The current queries share the prefix with the ones in the previous record during the same turn.
+        query_offset = 0
+        while query_offset < min(len(self.prev_queries), len(current_queries)) and self.prev_queries[query_offset] is current_queries[query_offset]:
+            query_offset += 1
+        record['query_offset'] = query_offset
+        record['new_queries'] = [convert_into_dict(msg) for msg in current_queries[query_offset:]]
+        self.prev_queries = list(current_queries)
+
+        # The actual prompt is stored as the indices of the text pool.
+        record['new_texts'] = []
+        record['actual_prompt'] = []
+        for text in prompt:
+            if text not in self.text_idxs:
+                self.text_idxs[text] = len(self.text_idxs)
+                record['new_texts'].append(text)
+            record['actual_prompt'].append(self.text_idxs[text])
+
+        # The rest of the context is bounded per step, so it is kept as it is.
+        for k, v in context.items():
+            if k not in ['scene', 'players', 'past_history', 'current_queries', 'actual_prompt']:
+                record[k] = v
+
+        return record
+
+
+# Rebuilding the full contexts from the gameplay logs. (Both the full and the delta records are supported.)
+def decode_gameplay_logs(records):
+    history, queries, texts = [], [], []
+    scene, players = None, []
+    for record in records:
+        if 'history_offset' not in record:  # The full context or the game result.
+            yield record
+            continue
+
+        # Restoring the states.
+        scene = {**scene, **record['scene_diff']} if scene is not None else dict(record['scene_diff'])
+        new_players = []
+        for p in range(record['num_players']):
+            diff = record['players_diff'].get(p, record['players_diff'].get(str(p), {}))  # JSON keys are always strings.
+            new_players.append({**players[p], **diff} if p < len(players) else dict(diff))
+        players = new_players
+
+        # Restoring the messages.
+        history += record['new_history']
+        assert len(history) == record['history_offset'], "The past history is not matched with the recorded offset."
+        queries = queries[:record['query_offset']] + record['new_queries']
+        texts += record['new_texts']
+
+        context = {
+            'scene': scene,
+            'players': players,
+            'past_history': history[:record['history_offset']],
+            'current_queries': deepcopy(queries),
+            'actual_prompt': [texts[idx] for idx in record['actual_prompt']],
+        }
+        for k, v in record.items():
+            if k not in ['scene_diff', 'players_diff', 'num_players', 'history_offset', 'new_history', 'query_offset', 'new_queries', 'new_texts', 'actual_prompt']:
+                context[k] = v
+
+        yield context
+
+
+# Opening a gameplay log file with the compression inferred from the extension.
+def open_log_file(path: str, mode: str):
+    if path.endswith('.gz'):
+        return gzip.open(path, f"{mode}t", encoding='utf-8')
+    if path.endswith('.zst'):
+        try:
+            import zstandard
+        except ImportError as e:
+            raise ImportError("The zstd compression requires the 'zstandard' package. Install it with 'pip install zstandard'.") from e
+        return zstandard.open(path, f"{mode}t", encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+
+# Stripping the extension of a gameplay log file.
+def get_log_name(path: str):
+    file_name = path.split('/')[-1]
+    for ext in ['.jsonl.gz', '.jsonl.zst', '.jsonl', '.json']:
+        if file_name.endswith(ext):
+            return file_name[:-len(ext)]
+    return file_name
+
+
+# The writer which appends each record to a JSONL file as soon as it is produced.
+# This can replace the gameplay log list in the manager since it supports append().
+class JsonlLogWriter():
+    def __init__(self, path: str, flush_period: int=1):
+        self.path = path
+        self.flush_period = flush_period
+        self.num_records = 0
+        self.buffer = []
+        self.file = open_log_file(path, 'w')
+
+    def __len__(self):
+        return self.num_records
+
+    # Adding one record. The buffered records are flushed periodically.
+    def append(self, record: dict):
+        self.buffer.append(json.dumps(record) + '\n')
+        self.num_records += 1
+        if len(self.buffer) >= self.flush_period:
+            self.flush()
+
+    def flush(self):
+        if self.file is None:
+            return
+        if len(self.buffer) > 0:
+            self.file.write(''.join(self.buffer))
+            self.buffer = []
+        self.file.flush()
+
+    def close(self):
+        if self.file is None:
+            return
+        self.flush()
+        self.file.close()
+        self.file = None
+
+
+# Loading the gameplay logs incrementally. The JSONL file is read line by line.
+def load_gameplay_logs(path: str):
+    if not path.endswith('.json'):
+        with open_log_file(path, 'r') as f:
+            try:
+                for line in f:
+                    line = line.strip()
+                    if len(line) == 0:
+                        continue
+                    try:
+                        yield json.loads(line)
+                    except json.decoder.JSONDecodeError:  # The last line might be cut off if the game has crashed.
+                        log.warning(f"The incomplete record in {path} has been skipped.")
+            except EOFError:  # The compressed stream might not have been closed if the game has crashed.
+                log.warning(f"The compressed stream in {path} ended unexpectedly.")
+        return
+
+    with open(path, 'r') as f:
+        data = json.load(f)
+    for record in data:
+        yield record
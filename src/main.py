@@ -4,6 +4,7 @@ from kani.models import ChatMessage
 from kani.engines.openai import OpenAIEngine
 from agents.player import Player, PlayerKani
 from agents.manager import GameManager
+from gameplay_logs import JsonlLogWriter
 from constants import ASSISTANT_INSTRUCTION, USER_INSTRUCTION, GAME_TIME_LIMIT, SYSTEM_TIME_LIMIT,  PER_PLAYER_TIME, ONE_HOUR
 from typing import Dict
 from argparse import Namespace
@@ -146,8 +147,7 @@ def main(manager: GameManager, args: Namespace):
                     'condition': 'The players failed to beat the game in the time limit.'
                 })
                 break
-            succ = await manager.validate_success_condition()
-            fail = await manager.validate_failure_condition()
+            succ, fail = await manager.validate_conditions()
 
             if succ and fail:
                 print_system_log("CONTRADICTORY VALIDATION BETWEEN SUCCESS AND FAILURE. KEEPING THE GAME SCENE MORE.")
@@ -179,6 +179,8 @@ def main(manager: GameManager, args: Namespace):
                 'game_result': 'timeout',
                 'condition': "The game stuck before finishing a turn."
             })
+        finally:
+            await manager.finish()  # The background summarization should be finished before the loop is closed.
 
     loop.run_until_complete(main_logic())
     loop.close()
@@ -203,13 +205,28 @@ if __name__=='__main__':
     parser.add_argument('--export_data', action='store_true', help="Setting whether to export the gameplay data after the game for the evaluation purpose.")
     parser.add_argument('--num_ai_players', type=int, default=0, help="The number of AI players to simulate.")
     parser.add_argument('--result_dir', type=str, default="results", help="The parent directory of the exported result.")
+    parser.add_argument('--log_format', type=str, default='full', help="The format of the exported gameplay logs.")
+    parser.add_argument('--export_format', type=str, default='json', help="The file format for exporting the gameplay logs.")
+    parser.add_argument('--log_compression', type=str, help="The compression of the exported JSONL file.")
+    parser.add_argument('--flush_period', type=int, default=1, help="The number of records to buffer before flushing them into the JSONL file.")
 
     # Parameters for the prompt construction.
     parser.add_argument('--concat_policy', type=str, default='simple', help="The concatenation policy for including the previous chat logs.")
     parser.add_argument('--max_num_msgs', type=int, help="The maximum number of messages to be included in the prompt as chat history.")
     parser.add_argument('--summarization', action='store_true', help="Setting whether to include the summarization or not.")
     parser.add_argument('--summ_period', type=int, help="The summarization period in terms of the number of turns.")
+    parser.add_argument('--summ_budget', type=float, help="The fraction of the context window which the chat logs since the last summarization can use before being summarized.")
     parser.add_argument('--clear_raw_logs', action='store_true', help="Setting whether to remove the raw chat logs after the summarization.")
+    parser.add_argument('--async_summarization', action='store_true', help="Setting whether to run the periodic summarization in the background.")
+    parser.add_argument('--summ_merge_size', type=int, help="The number of summaries in the same level which are merged into a higher-level summary.")
+    parser.add_argument('--embedding_precision', type=str, default='float32', help="The precision of the stored sentence embeddings for the retrieval.")
+    parser.add_argument('--embedding_cache_dir', type=str, default=".cache/embeddings", help="The directory of the on-disk cache of the rule embeddings.")
+    parser.add_argument('--encoder_backend', type=str, default='torch', help="The backend of the sentence encoder for the retrieval.")
+    parser.add_argument('--encoder_threads', type=int, help="The number of CPU threads for the sentence encoder.")
+    parser.add_argument('--retrieval_index', type=str, default='exact', help="The index for the retrieval concatenation.")
+    parser.add_argument('--ann_threshold', type=int, default=4096, help="The number of messages from which the IVF index starts the approximate search.")
+    parser.add_argument('--validation_policy', type=str, default='full', help="The policy of the chat history for validating the success/failure conditions.")
+    parser.add_argument('--validation_window', type=int, help="The number of the last messages which are always included for the validation.")
 
     # Parameters for toggling the additional contexts.
     parser.add_argument('--include_functions', action='store_true', help="Setting whether to use function calls or not.")
@@ -217,6 +234,8 @@ if __name__=='__main__':
     parser.add_argument('--include_scene_state', action='store_true', help="Setting whether to include the state of the current scene.")
     parser.add_argument('--include_player_states', action='store_true', help="Setting whether to include the states of the players.")
     parser.add_argument('--generate_states', action='store_true', help="Setting whether to use a model to directly generate the scene/player states.")
+    parser.add_argument('--state_detection', type=str, default='sequential', help="The way of detecting the state changes when generate_states is set.")
+    parser.add_argument('--state_update_protocol', type=str, default='full', help="The way of updating the changed states when generate_states is set.")
 
     # Parameters for the response generation.
     parser.add_argument('--max_tokens', type=int, help="The maximum number of tokens to generate.")
@@ -227,20 +246,48 @@ if __name__=='__main__':
 
     args = parser.parse_args()
 
-    assert args.rule_injection in ['full', 'retrieval'], "Specify an available rule injection option: 'full' / 'retrieval', or leave it as non-specified."
+    assert args.rule_injection in ['full', 'retrieval', 'hybrid', 'lexical'], "Specify an available rule injection option: 'full' / 'retrieval' / 'hybrid' / 'lexical', or leave it as non-specified."
+    assert args.embedding_precision in ['float64', 'float32', 'int8'], "Specify an available embedding precision: 'float64' / 'float32' / 'int8', or leave it as non-specified."
+    assert args.encoder_backend in ['torch', 'quantized'], "Specify an available encoder backend: 'torch' / 'quantized', or leave it as non-specified."
+    assert args.validation_policy in ['full', 'window', 'retrieval', 'summary'], "Specify an available validation policy: 'full' / 'window' / 'retrieval' / 'summary', or leave it as non-specified."
+    if args.validation_policy == 'full':
+        assert args.validation_window is None, "To use validation_window, you must set validation_policy other than 'full'."
+    else:
+        assert args.validation_window is not None and args.validation_window > 0, "To use the validation policy other than 'full', you must set validation_window to a positive integer."
+    assert args.log_format in ['full', 'delta'], "Specify an available log format: 'full' / 'delta', or leave it as non-specified."
+    assert args.export_format in ['json', 'jsonl'], "Specify an available export format: 'json' / 'jsonl', or leave it as non-specified."
+    if args.log_compression is not None:
+        assert args.export_format == 'jsonl', "To use log_compression, you must set export_format to 'jsonl'."
+        assert args.log_compression in ['gzip', 'zstd'], "Specify an available compression: 'gzip' / 'zstd', or leave it as non-specified."
+    assert args.flush_period > 0, "The flush period should be a positive integer."
     if not args.summarization:
         assert args.summ_period is None, "To use summ_period, you must set the summarization argument."
+        assert args.summ_budget is None, "To use summ_budget, you must set the summarization argument."
         assert args.clear_raw_logs is False, "To use clear_raw_logs, you must set the summarization argument."
-    if args.summarization and args.summ_period is None:
+        assert args.async_summarization is False, "To use async_summarization, you must set the summarization argument."
+        assert args.summ_merge_size is None, "To use summ_merge_size, you must set the summarization argument."
+    if args.summ_budget is not None:
+        assert 0.0 < args.summ_budget < 1.0, "summ_budget should be between 0.0 and 1.0."
+    if args.summ_merge_size is not None:
+        assert args.summ_merge_size >= 2, "summ_merge_size should be at least 2."
+    if args.summarization and args.summ_period is None and args.summ_budget is None:
+        assert args.async_summarization is False, "To use async_summarization, you must set summ_period or summ_budget."
+        assert args.summ_merge_size is None, "To use summ_merge_size, you must set summ_period or summ_budget."
         print_system_log("SUMMARIZATION WITHOUT PERIOD WILL IGNORE ALL OTHER SETTINGS FOR PROMPT. THE WHOLE CHAT LOGS WILL BE SUMMARIZED INTO A PROMPT.")
     else:
         assert args.concat_policy in ['simple', 'retrieval'], "The concatenation policy should be either 'simple' or 'retrieval'."
+        assert args.retrieval_index in ['exact', 'ivf'], "Specify an available retrieval index: 'exact' / 'ivf', or leave it as non-specified."
         if args.max_num_msgs is None:
             print_system_log("ANY CONCATENATION POLICY WITH NO SPECIFIC MAX NUMBER OF MESSAGES WOULD BE CASTED INTO THE SIMPLE CONCATENATION.")
             args.concat_policy = 'simple'  # The retrieval concatenation without any number of turns is not different from the simple concatenation.
+    assert args.state_detection in ['sequential', 'batched'], "Specify an available state detection: 'sequential' / 'batched', or leave it as non-specified."
+    assert args.state_update_protocol in ['full', 'patch'], "Specify an available state update protocol: 'full' / 'patch', or leave it as non-specified."
     if args.generate_states:
         print_system_log("YOU SET update_state=True WHICH AUTOMATICALLY TURNS OFF include_functions.")
         args.include_functions = False
+    else:
+        assert args.state_detection == 'sequential', "To use the batched state detection, you must set the generate_states argument."
+        assert args.state_update_protocol == 'full', "To use the patch-based state update, you must set the generate_states argument."
 
     # Creating the engine.
     random.seed(args.seed)
@@ -295,16 +342,31 @@ if __name__=='__main__':
     manager.players = players
     manager.name_to_idx = {player.name: idx for idx, player in enumerate(players)}
 
-    # The main game logic.
-    main(manager, args)
-
-    # Exporting data after finishing the scene.
+    # Setting the export path.
     if args.export_data:
         scene_dir = args.scene_path.split('/')[1]
         file_dir = f"{args.result_dir}/model={args.model_idx}/{scene_dir}"
         if not os.path.isdir(file_dir):
             os.makedirs(file_dir)
 
-        file_path = f"{file_dir}/{owner_name}-seed={args.seed}-time={execution_time}.json"
+        file_path = f"{file_dir}/{owner_name}-seed={args.seed}-time={execution_time}.{args.export_format}"
+
+        # The JSONL logs are written during the game, so the records so far are kept even if the game crashes.
+        if args.export_format == 'jsonl':
+            if args.log_compression == 'gzip':
+                file_path = f"{file_path}.gz"
+            elif args.log_compression == 'zstd':
+                file_path = f"{file_path}.zst"
+            manager.gameplay_logs = JsonlLogWriter(file_path, flush_period=args.flush_period)
+
+    # The main game logic.
+    try:
+        main(manager, args)
+    finally:
+        if isinstance(manager.gameplay_logs, JsonlLogWriter):
+            manager.gameplay_logs.close()
+
+    # Exporting data after finishing the scene.
+    if args.export_data and args.export_format == 'json':
         with open(file_path, 'w') as f:
             json.dump(manager.gameplay_logs, f)
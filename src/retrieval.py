@@ -0,0 +1,282 @@
+from typing import Tuple
+from embeddings import EmbeddingBuffer, normalize_embeddings
+from concurrent.futures import ThreadPoolExecutor
+
+import re
+import math
+import numpy as np
+
+INDEX_TYPES = ['exact', 'ivf']
+STOPWORDS = {
+    'a', 'an', 'the', 'and', 'or', 'but', 'if', 'then', 'of', 'to', 'in', 'on', 'at', 'by', 'for', 'with', 'from', 'as', 'into',
+    'is', 'are', 'was', 'were', 'be', 'been', 'being', 'am', 'do', 'does', 'did', 'has', 'have', 'had', 'can', 'could', 'should',
+    'would', 'will', 'shall', 'may', 'might', 'must', 'it', 'its', 'this', 'that', 'these', 'those', 'there', 'their', 'they',
+    'them', 'he', 'him', 'his', 'she', 'her', 'we', 'us', 'our', 'you', 'your', 'i', 'me', 'my', 'what', 'which', 'who', 'whom',
+    'how', 'when', 'where', 'why', 'not', 'no', 'so', 'than', 'too', 'very', 'also', 'just', 'any', 'all', 'each', 'other', 'such'
+}
+
+
+# The brute-force index which compares the queries with all stored embeddings.
+class ExactIndex():
+    def __init__(self, precision: str='float32'):
+        self.buffer = EmbeddingBuffer(precision=precision)
+
+    def __len__(self):
+        return len(self.buffer)
+
+    # Adding the new embeddings at the end.
+    def append(self, embs: np.ndarray):
+        self.buffer.append(embs)
+
+    # Inserting the new embeddings at the given index. The indices after it are shifted.
+    def insert(self, idx: int, embs: np.ndarray):
+        self.buffer.insert(idx, embs)
+
+    # Removing the embeddings in [start, end). The indices after them are shifted.
+    def delete(self, start: int, end: int):
+        self.buffer.delete(start, end)
+
+    # Getting the candidates and their max-pooled cosine similarities with the queries.
+    # The candidate indices are always in ascending order.
+    def search(self, query_embs: np.ndarray, min_candidates: int=0) -> Tuple[np.ndarray, np.ndarray]:
+        scores = self.buffer.similarity(query_embs).max(axis=0)  # (N)
+        return np.arange(len(self.buffer)), scores
+
+
+# The inverted file index which only compares the queries with the embeddings in the closest clusters.
+# The search is exact until the number of embeddings reaches the threshold.
+# The clusters are re-trained whenever the number of embeddings is doubled since the last training.
+# The training runs on a background thread with a copy of the embeddings, and the previous centroids are used until it is finished.
+class IVFIndex(ExactIndex):
+    def __init__(self,
+        precision: str='float32',
+        threshold: int=4096,
+        num_probes: int=8,
+        num_iters: int=5,
+        max_train_size: int=16384,
+        seed: int=0
+    ):
+        super().__init__(precision)
+        self.threshold = threshold
+        self.num_probes = num_probes
+        self.num_iters = num_iters
+        self.max_train_size = max_train_size
+        self.rng = np.random.default_rng(seed)  # Only used by the training.
+
+        self.centroids = None  # (K, d)
+        self.assignments = np.empty(64, dtype='int32')  # The cluster of each embedding.
+        self.trained_size = 0
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='ivf')
+        self.training = None  # The future of the training running in the background.
+        self.changes = []  # ('insert' or 'delete', start, end) of the changes since the training has started.
+
+    # Assigning the embeddings to the closest centroids.
+    @staticmethod
+    def assign(embs: np.ndarray, centroids: np.ndarray, chunk_size: int=16384) -> np.ndarray:
+        res = np.empty(embs.shape[0], dtype='int32')
+        for start in range(0, embs.shape[0], chunk_size):
+            end = min(start + chunk_size, embs.shape[0])
+            res[start:end] = np.argmax(embs[start:end] @ centroids.T, axis=1)
+        return res
+
+    # Training the centroids with the spherical k-means on a sample of the embeddings and assigning all of them.
+    # This runs on the background thread, so it only reads the given copy of the embeddings.
+    def fit(self, buffer: EmbeddingBuffer) -> Tuple[np.ndarray, np.ndarray]:
+        num_embs = len(buffer)
+        sample_idxs = np.sort(self.rng.choice(num_embs, min(num_embs, self.max_train_size), replace=False))
+        sample = buffer.dequantize(sample_idxs)  # (S, d)
+        num_lists = min(max(int(2 * np.sqrt(num_embs)), 1), sample.shape[0])
+
+        centroids = sample[self.rng.choice(sample.shape[0], num_lists, replace=False)]
+        for _ in range(self.num_iters):
+            sample_assignments = self.assign(sample, centroids)
+
+            # Summing the embeddings in each cluster after grouping them by the clusters.
+            order = np.argsort(sample_assignments, kind='stable')
+            counts = np.bincount(sample_assignments, minlength=num_lists)
+            non_empty = counts > 0
+            sums = centroids.copy()  # The empty clusters keep the previous centroids.
+            sums[non_empty] = np.add.reduceat(sample[order], (np.cumsum(counts) - counts)[non_empty], axis=0)
+            centroids = normalize_embeddings(sums)
+
+        return centroids, self.assign(buffer.dequantize(), centroids)
+
+    # Starting the training in the background with a copy of the current embeddings.
+    def train(self):
+        num_embs = len(self.buffer)
+        scales = self.buffer.scales[:num_embs].copy() if self.buffer.scales is not None else None
+        snapshot = EmbeddingBuffer.from_arrays(self.buffer.view().copy(), scales)
+        self.trained_size = num_embs
+        self.changes = []
+        self.training = self.executor.submit(self.fit, snapshot)
+
+    # Replacing the centroids and assignments if the training has been finished.
+    # The changes during the training are replayed, and the new embeddings since then are assigned to the new centroids.
+    def apply_training(self, wait: bool=False):
+        if self.training is None or (not wait and not self.training.done()):
+            return
+        centroids, assignments = self.training.result()
+        self.training = None
+
+        for op, start, end in self.changes:
+            if op == 'insert':
+                assignments = np.insert(assignments, start, np.full(end - start, -1, dtype='int32'))
+            else:
+                assignments = np.delete(assignments, np.arange(start, end))
+        self.changes = []
+
+        missing = np.flatnonzero(assignments < 0)
+        if len(missing) > 0:
+            assignments[missing] = self.assign(self.buffer.dequantize(missing), centroids)
+        self.centroids = centroids
+        self.assignments[:len(self.buffer)] = assignments
+
+    # Waiting for the training running in the background.
+    def wait_training(self):
+        self.apply_training(wait=True)
+
+    # Adding the new embeddings at the end and assigning them to the current centroids.
+    def add(self, embs: np.ndarray):
+        start = len(self.buffer)
+        self.buffer.append(embs)
+        end = len(self.buffer)
+
+        if self.assignments.shape[0] < end:
+            new_assignments = np.empty(self.buffer.data.shape[0], dtype='int32')
+            new_assignments[:start] = self.assignments[:start]
+            self.assignments = new_assignments
+        if self.centroids is not None:
+            self.assignments[start:end] = self.assign(self.buffer.dequantize(np.arange(start, end)), self.centroids)
+
+    # Recording the change for the training running in the background, or starting a new training if the embeddings have been doubled.
+    def record_change(self, op: str, start: int, end: int):
+        if self.training is not None:
+            if len(self.changes) > 0 and self.changes[-1][0] == op == 'insert' and self.changes[-1][2] == start:  # Merging the consecutive appends.
+                self.changes[-1] = (op, self.changes[-1][1], end)
+            else:
+                self.changes.append((op, start, end))
+        elif len(self.buffer) >= self.threshold and len(self.buffer) >= 2 * self.trained_size:
+            self.train()
+
+    def append(self, embs: np.ndarray):
+        self.apply_training()
+        start = len(self.buffer)
+        self.add(embs)
+        self.record_change('insert', start, len(self.buffer))
+
+    def insert(self, idx: int, embs: np.ndarray):
+        self.apply_training()
+        num_left = len(self.buffer) - idx
+        self.add(embs)
+
+        # Moving the new embeddings and their clusters to the index.
+        num_new, end = embs.shape[0], len(self.buffer)
+        if num_left > 0:
+            new_assignments = self.assignments[end-num_new:end].copy()
+            self.assignments[idx+num_new:end] = self.assignments[idx:idx+num_left]
+            self.assignments[idx:idx+num_new] = new_assignments
+            self.buffer.delete(end-num_new, end)
+            self.buffer.insert(idx, embs)
+        self.record_change('insert', idx, idx+num_new)
+
+    def delete(self, start: int, end: int):
+        self.apply_training()
+        num_left = len(self.buffer) - end
+        self.assignments[start:start+num_left] = self.assignments[end:len(self.buffer)]
+        self.buffer.delete(start, end)
+        if self.training is not None:
+            self.changes.append(('delete', start, end))
+
+    def search(self, query_embs: np.ndarray, min_candidates: int=0) -> Tuple[np.ndarray, np.ndarray]:
+        self.apply_training()
+        if self.centroids is None or len(self.buffer) < self.threshold:
+            return super().search(query_embs, min_candidates)
+
+        # Probing the closest clusters of each query.
+        query_embs = normalize_embeddings(query_embs)
+        centroid_sims = query_embs @ self.centroids.T  # (Q, K)
+        num_probes = min(self.num_probes, self.centroids.shape[0])
+        probes = np.unique(np.argpartition(-centroid_sims, num_probes-1, axis=1)[:, :num_probes])
+        candidates = np.flatnonzero(np.isin(self.assignments[:len(self.buffer)], probes))  # Ascending.
+
+        # The exact search is used if the probed clusters do not have enough embeddings.
+        if len(candidates) < min_candidates:
+            return super().search(query_embs, min_candidates)
+
+        scores = self.buffer.similarity(query_embs, candidates).max(axis=0)  # (C)
+        return candidates, scores
+
+
+# Selecting the top-k candidates by the max-pooled similarities without sorting all of them.
+# The selected indices are returned in ascending order, so the original order of the candidates is kept.
+def max_pooled_top_k(cos_sims: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    scores = cos_sims.max(axis=0) if cos_sims.ndim == 2 else cos_sims  # (C)
+    if k >= scores.shape[0]:
+        idxs = np.arange(scores.shape[0])
+    else:
+        idxs = np.sort(np.argpartition(-scores, k-1)[:k])
+    return idxs, scores[idxs]
+
+
+# Splitting a text into the lowercased terms without the stopwords.
+def tokenize(text: str) -> list[str]:
+    terms = []
+    for token in re.findall(r"[a-z0-9]+", text.lower()):
+        if token in STOPWORDS:
+            continue
+        if len(token) > 3 and token.endswith('s') and not token.endswith('ss'):
+            token = token[:-1]  # Simple stemming for the plural forms.
+        terms.append(token)
+    return terms
+
+
+# The lexical index with the inverted lists of the BM25 weights.
+# The weight of each (term, document) pair is precomputed, so the scoring is only the additions over the query terms.
+class BM25Index():
+    def __init__(self, docs: list[str], k1: float=1.5, b: float=0.75):
+        self.num_docs = len(docs)
+        doc_terms = [tokenize(doc) for doc in docs]
+        avg_len = max(sum(len(terms) for terms in doc_terms) / max(self.num_docs, 1), 1.0)
+
+        term_freqs = {}  # term => {doc => frequency}
+        for d, terms in enumerate(doc_terms):
+            for term in terms:
+                term_freqs.setdefault(term, {})
+                term_freqs[term][d] = term_freqs[term].get(d, 0) + 1
+
+        self.index = {}  # term => (doc indices, weights)
+        for term, freqs in term_freqs.items():
+            idf = math.log(1.0 + (self.num_docs - len(freqs) + 0.5) / (len(freqs) + 0.5))
+            doc_idxs = np.array(list(freqs.keys()))
+            tfs = np.array(list(freqs.values()), dtype='float32')
+            doc_lens = np.array([len(doc_terms[d]) for d in doc_idxs], dtype='float32')
+            weights = idf * tfs * (k1 + 1) / (tfs + k1 * (1 - b + b * doc_lens / avg_len))
+            self.index[term] = (doc_idxs, weights.astype('float32'))
+
+    # Calculating the BM25 scores between the queries and all documents.
+    def score(self, queries: list[str]) -> np.ndarray:
+        scores = np.zeros((len(queries), self.num_docs), dtype='float32')
+        for q, query in enumerate(queries):
+            for term in tokenize(query):
+                if term in self.index:
+                    doc_idxs, weights = self.index[term]
+                    scores[q, doc_idxs] += weights
+        return scores  # (Q, N)
+
+
+# Fusing multiple scores of the same candidates with the reciprocal rank fusion.
+# The tied scores get the same rank, so the candidates without any lexical match are not ordered arbitrarily.
+def reciprocal_rank_fusion(all_scores: list[np.ndarray], k: int=60) -> np.ndarray:
+    fused = np.zeros(all_scores[0].shape[0], dtype='float32')
+    for scores in all_scores:
+        ranks = np.searchsorted(np.sort(-scores), -scores, side='left')  # (C)
+        fused += 1.0 / (k + ranks + 1)
+    return fused  # (C)
+
+
+# Building the retrieval index of the given type.
+def build_index(index_type: str, precision: str='float32', threshold: int=4096):
+    assert index_type in INDEX_TYPES, f"The retrieval index should be one of {INDEX_TYPES}."
+    if index_type == 'ivf':
+        return IVFIndex(precision=precision, threshold=threshold)
+    return ExactIndex(precision=precision)
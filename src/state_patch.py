@@ -0,0 +1,99 @@
+from copy import copy
+from typing import Any, Tuple
+
+PATCH_OPS = ['add', 'remove', 'replace']
+
+
+# The error when the model output cannot be used for updating the game states.
+class StateUpdateError(Exception):
+    pass
+
+
+# Parsing a JSON pointer into the list of keys. (e.g. '/inventory/Rope' => ['inventory', 'Rope'])
+def parse_path(path: Any) -> list[str]:
+    if not isinstance(path, str) or not path.startswith('/'):
+        raise StateUpdateError(f"The path {path} is not a valid JSON pointer.")
+    return [key.replace('~1', '/').replace('~0', '~') for key in path[1:].split('/')]
+
+
+# Getting the child of a container. The list index should be an existing one.
+def get_child(parent: Any, key: str, path: str) -> Any:
+    if isinstance(parent, dict):
+        if key not in parent:
+            raise StateUpdateError(f"The path {path} does not exist.")
+        return parent[key]
+    if isinstance(parent, list):
+        if not key.isdigit() or int(key) >= len(parent):
+            raise StateUpdateError(f"The path {path} does not exist.")
+        return parent[int(key)]
+    raise StateUpdateError(f"The path {path} goes through a value which is not a container.")
+
+
+# Applying one operation to the last key of the path.
+def apply_op(parent: Any, key: str, op: dict, path: str):
+    if isinstance(parent, dict):
+        if op['op'] != 'add' and key not in parent:
+            raise StateUpdateError(f"The path {path} does not exist.")
+        if op['op'] == 'remove':
+            parent.pop(key)
+        else:
+            parent[key] = op['value']
+        return
+
+    if isinstance(parent, list):
+        if op['op'] == 'add' and key == '-':  # Appending at the end.
+            parent.append(op['value'])
+            return
+        max_idx = len(parent) if op['op'] == 'add' else len(parent) - 1
+        if not key.isdigit() or int(key) > max_idx:
+            raise StateUpdateError(f"The index in the path {path} is out of range.")
+        if op['op'] == 'add':
+            parent.insert(int(key), op['value'])
+        elif op['op'] == 'remove':
+            parent.pop(int(key))
+        else:
+            parent[int(key)] = op['value']
+        return
+
+    raise StateUpdateError(f"The path {path} goes through a value which is not a container.")
+
+
+# Applying the patch operations to the state without changing it.
+# Only the containers along the changed paths are copied, and the others are shared with the previous state.
+# Only the given fields can be changed, and each field should keep its type.
+# Returns the new state and the fields which have been changed.
+def apply_state_patch(state: dict, ops: Any, fields: list[str]) -> Tuple[dict, list[str]]:
+    if not isinstance(ops, list):
+        raise StateUpdateError("The patch is not a list of operations.")
+
+    new_state = dict(state)
+    copied = set()  # The ids of the containers which have been copied in this patch.
+    for op in ops:
+        if not isinstance(op, dict) or op.get('op') not in PATCH_OPS:
+            raise StateUpdateError(f"The operation {op} should be a JSON object whose 'op' is one of {PATCH_OPS}.")
+        if op['op'] != 'remove' and 'value' not in op:
+            raise StateUpdateError(f"The operation {op} does not have the value.")
+
+        keys = parse_path(op.get('path'))
+        if keys[0] not in fields:
+            raise StateUpdateError(f"The path {op['path']} is not under the updatable fields {fields}.")
+        if len(keys) == 1 and op['op'] == 'remove':
+            raise StateUpdateError(f"The field {keys[0]} cannot be removed.")
+
+        # Copying the containers along the path before changing them.
+        parent = new_state
+        for key in keys[:-1]:
+            child = get_child(parent, key, op['path'])
+            if id(child) not in copied:
+                child = copy(child)
+                copied.add(id(child))
+                parent[int(key) if isinstance(parent, list) else key] = child
+            parent = child
+        apply_op(parent, keys[-1], op, op['path'])
+
+    changed = [field for field in fields if new_state[field] is not state[field]]
+    for field in changed:
+        if type(new_state[field]) != type(state[field]):
+            raise StateUpdateError(f"The field {field} should be {type(state[field]).__name__}, not {type(new_state[field]).__name__}.")
+
+    return new_state, changed
@@ -0,0 +1,90 @@
+from kani.models import ChatMessage, ChatRole
+from kani.exceptions import MessageTooLong
+from typing import Callable, Tuple
+from bisect import bisect_left
+
+import weakref
+
+
+# The token lengths of the messages memoized by the message identity.
+# The messages are immutable, so looking up by the identity skips hashing the whole content every time.
+# On a miss, len_fn is called, which looks up the length by the content hash. (e.g. Kani.message_token_len)
+class TokenLengthCache():
+    def __init__(self, len_fn: Callable[[ChatMessage], int]):
+        self.len_fn = len_fn
+        self.lens = {}  # id(message) => length
+
+    def __len__(self):
+        return len(self.lens)
+
+    def __call__(self, message: ChatMessage) -> int:
+        key = id(message)
+        length = self.lens.get(key)
+        if length is None:
+            length = self.len_fn(message)
+            self.lens[key] = length
+            weakref.finalize(message, self.lens.pop, key, None)  # The id can be reused after the message is gone.
+        return length
+
+
+# The prefix sums of the token lengths of a message list which grows by appending. (e.g. chat_history)
+# This makes the truncation in get_prompt a binary search instead of counting the tokens of every message.
+class PrefixTokenLengths():
+    def __init__(self, len_fn: Callable[[ChatMessage], int]):
+        self.len_fn = len_fn
+        self.source = None  # The list which has been synced last time.
+        self.messages = []
+        self.sums = [0]
+
+    # Syncing with the current messages.
+    # If the same list has only grown, only the new messages are counted.
+    # Otherwise, the sums are kept for the longest common prefix and the rest are counted again.
+    def sync(self, messages: list[ChatMessage]):
+        num_synced = len(self.messages)
+        if messages is not self.source or len(messages) < num_synced or (num_synced > 0 and messages[num_synced-1] is not self.messages[-1]):
+            num_synced = next((i for i, (a, b) in enumerate(zip(self.messages, messages)) if a is not b), min(num_synced, len(messages)))
+            del self.messages[num_synced:]
+            del self.sums[num_synced+1:]
+            self.source = messages
+
+        for message in messages[num_synced:]:
+            self.messages.append(message)
+            self.sums.append(self.sums[-1] + self.len_fn(message))
+
+    # Counting the messages to keep from the end of messages[start:] + tail, whose total length is within max_size.
+    # This gives the same result as the reversed loop in Kani.get_prompt.
+    # The tail is short (e.g. the current queries), so it is counted one by one.
+    # Returns the number of the messages to keep and their total length.
+    def truncate(self, max_size: int, start: int=0, tail: list[ChatMessage]=[]) -> Tuple[int, int]:
+        to_keep, total_tokens = 0, 0
+        for message in reversed(tail):
+            message_len = self.len_fn(message)
+            if total_tokens + message_len > max_size:
+                check_message_len(message, message_len, max_size)
+                return to_keep, total_tokens
+            to_keep += 1
+            total_tokens += message_len
+
+        end = len(self.messages)
+        idx = min(max(bisect_left(self.sums, self.sums[end] - (max_size - total_tokens), lo=start), start), end)
+        to_keep += end - idx
+        total_tokens += self.sums[end] - self.sums[idx]
+        if idx > start:  # The last message checked, which does not fit.
+            check_message_len(self.messages[idx-1], self.sums[idx] - self.sums[idx-1], max_size)
+
+        return to_keep, total_tokens
+
+
+# Raising the same error as Kani.get_prompt if a message can never fit in the context window.
+def check_message_len(message: ChatMessage, message_len: int, max_size: int):
+    if message_len > max_size:
+        func_help = (
+            ""
+            if message.role != ChatRole.FUNCTION
+            else "You may set `auto_truncate` in the @ai_function to automatically truncate long responses.\n"
+        )
+        raise MessageTooLong(
+            "The chat message's size is longer than the allowed context window (after including system"
+            " messages, always included messages, and desired response tokens).\n"
+            f"{func_help}Content: {message.text[:100]}..."
+        )
@@ -0,0 +1,85 @@
+import os
+import sys
+
+cur_dir = os.path.dirname(__file__)
+src_path = os.path.abspath(os.path.join(cur_dir, '..', 'src'))
+sys.path.insert(0, src_path)
+
+from kani.engines.base import BaseEngine, Completion
+from kani.models import ChatMessage
+from agents.manager import GameManager
+from embeddings import get_encoder
+from constants import SENTENCE_ENCODER
+from argparse import Namespace
+
+import hashlib
+import numpy as np
+import pytest
+
+
+# The engine which replies with the scripted outputs, or with a numbered reply if there is no script left.
+class FakeEngine(BaseEngine):
+    max_context_size = 4096
+
+    def __init__(self, outputs: list[str]=None):
+        self.outputs = list(outputs) if outputs is not None else []
+        self.calls = []
+
+    def message_len(self, message: ChatMessage) -> int:
+        return len((message.text or '').split()) + 4
+
+    def function_token_reserve(self, functions) -> int:
+        return 0
+
+    async def predict(self, messages: list[ChatMessage], functions=None, **hyperparams) -> Completion:
+        self.calls.append(messages)
+        content = self.outputs.pop(0) if len(self.outputs) > 0 else f"Reply {len(self.calls)}."
+        return Completion(ChatMessage.assistant(content))
+
+
+# The sentence encoder which gives a fixed embedding for each text without loading the model.
+class FakeEncoderModel():
+    def encode(self, contents: list[str], **kwargs) -> np.ndarray:
+        if len(contents) == 0:
+            return np.empty((0, 16), dtype=np.float32)
+        return np.stack([np.frombuffer(hashlib.sha256(content.encode('utf-8')).digest()[:16], dtype=np.uint8).astype(np.float32) - 128 for content in contents])
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return 16
+
+
+SCENE = {
+    'chapter': "Chapter 1",
+    'scene': "Scene 1",
+    'scene_summary': ["The players are in front of the gate."],
+    'npcs': {},
+    'success_condition': "The players open the gate.",
+    'failure_condition': "The players give up.",
+    'game_flow': ["The players find the key."],
+    'environment': {},
+    'random_tables': {},
+    'consequences': "The players move to the next scene."
+}
+
+
+# Making a manager with the fake engine. The keyword arguments override the default arguments.
+@pytest.fixture
+def make_manager():
+    def make(outputs: list[str]=None, **kwargs):
+        main_args = Namespace(**{
+            'concat_policy': 'simple', 'max_num_msgs': None, 'summarization': False, 'summ_period': None, 'summ_budget': None, 'clear_raw_logs': False,
+            'async_summarization': False, 'summ_merge_size': None, 'rule_injection': 'full', 'embedding_precision': 'float32', 'embedding_cache_dir': None,
+            'retrieval_index': 'exact', 'ann_threshold': 4096, 'encoder_backend': 'torch', 'encoder_threads': None, 'log_format': 'full',
+            'validation_policy': 'full', 'validation_window': None, 'state_detection': 'sequential', 'state_update_protocol': 'full',
+            **kwargs
+        })
+        get_encoder(SENTENCE_ENCODER, main_args.encoder_backend, main_args.encoder_threads).model = FakeEncoderModel()
+        engine = FakeEngine(outputs)
+        return GameManager(scene=dict(SCENE), main_args=main_args, engine=engine, system_prompt="You are the Goblin King."), engine
+    return make
+
+
+# Running one turn of the game with the given player message.
+async def play_turn(manager: GameManager, content: str, **kwargs) -> list[ChatMessage]:
+    params = {'generate_states': False, 'include_functions': False, 'include_rules': False, 'include_scene_state': False, 'include_player_states': False, **kwargs}
+    return [message async for message in manager.full_round([ChatMessage.user(content, name="Player 1")], **params)]
@@ -0,0 +1,55 @@
+from retrieval import ExactIndex, IVFIndex
+
+import threading
+import numpy as np
+import pytest
+
+
+# Making the random embeddings around a few topics.
+def make_embeddings(rng: np.random.Generator, num_embs: int, dim: int=16, num_topics: int=8):
+    topics = rng.standard_normal((num_topics, dim))
+    return (topics[rng.integers(num_topics, size=num_embs)] + 0.3 * rng.standard_normal((num_embs, dim))).astype('float32')
+
+
+# The index is changed while the training is running in the background.
+# The previous centroids are used until it is finished, and the changes are reflected in the new assignments after that.
+@pytest.mark.parametrize('precision', ['float32', 'int8'])
+def test_background_training(precision):
+    rng = np.random.default_rng(0)
+    index, exact = IVFIndex(precision=precision, threshold=64, num_probes=2), ExactIndex(precision=precision)
+    embs = make_embeddings(rng, 64)
+    index.append(embs)
+    exact.append(embs)
+    index.wait_training()
+    first_centroids = index.centroids
+
+    # Holding the next training until the changes are made.
+    release = threading.Event()
+    fit = index.fit
+    index.fit = lambda buffer: release.wait() and fit(buffer)
+
+    for step in range(8):
+        embs = make_embeddings(rng, 16)
+        index.append(embs)
+        exact.append(embs)
+    assert index.training is not None, "The training has not been started."
+
+    embs = make_embeddings(rng, 3)
+    index.insert(10, embs)
+    exact.insert(10, embs)
+    index.delete(40, 50)
+    exact.delete(40, 50)
+    index.insert(len(exact), embs)
+    exact.insert(len(exact), embs)
+
+    query_embs = make_embeddings(rng, 2)
+    candidates, scores = index.search(query_embs)
+    assert index.centroids is first_centroids, "The centroids have been changed before the training is finished."
+    assert np.allclose(scores, exact.buffer.similarity(query_embs, candidates).max(axis=0)), "The candidates are not matched with the embeddings."
+
+    release.set()
+    index.wait_training()
+    assert index.centroids is not first_centroids, "The new centroids have not been applied."
+    assert np.array_equal(index.buffer.view(), exact.buffer.view()), "The embeddings are different from the exact index."
+    expected = IVFIndex.assign(index.buffer.dequantize(), index.centroids)
+    assert np.array_equal(index.assignments[:len(index)], expected), "The assignments are not matched with the new centroids."
@@ -0,0 +1,72 @@
+from kani.models import ChatMessage
+from agents.player import Player
+from state_patch import StateUpdateError, apply_state_patch
+
+import asyncio
+import json
+import pytest
+
+
+# Making a player for the state updates.
+def make_player():
+    return Player(
+        name="Player 1", kin="Human", persona=["Brave."], goal="Escape the Labyrinth.",
+        traits={"Strong": "Can lift heavy things."}, flaws={"Slow": "Moves slowly."}, inventory={"Rope": "A long rope."}, additional_notes=[]
+    )
+
+
+# The operations are applied to the copies along the paths, and the other parts are shared with the previous state.
+def test_apply_state_patch():
+    state = {'environment': {'Gate': "A locked gate."}, 'random_tables': {'Names': ["A", "B"]}, 'is_action_scene': False}
+    ops = [
+        {'op': 'add', 'path': '/environment/Key', 'value': "A rusty key."},
+        {'op': 'remove', 'path': '/environment/Gate'},
+        {'op': 'add', 'path': '/random_tables/Names/-', 'value': "C"},
+        {'op': 'replace', 'path': '/random_tables/Names/0', 'value': "Z"}
+    ]
+    new_state, changed = apply_state_patch(state, ops, list(state.keys()))
+
+    assert new_state == {'environment': {'Key': "A rusty key."}, 'random_tables': {'Names': ["Z", "B", "C"]}, 'is_action_scene': False}
+    assert changed == ['environment', 'random_tables']
+    assert state == {'environment': {'Gate': "A locked gate."}, 'random_tables': {'Names': ["A", "B"]}, 'is_action_scene': False}, "The previous state has been changed."
+
+
+# Any wrong operation fails the whole patch.
+@pytest.mark.parametrize('ops', [
+    {'op': 'add', 'path': '/environment/Key', 'value': "A rusty key."},
+    [{'op': 'move', 'path': '/environment/Gate'}],
+    [{'op': 'remove', 'path': '/environment/Door'}],
+    [{'op': 'replace', 'path': '/chapter', 'value': "Chapter 2"}],
+    [{'op': 'replace', 'path': '/is_action_scene', 'value': "true"}],
+    [{'op': 'remove', 'path': '/environment'}],
+    [{'op': 'add', 'path': '/random_tables/Names/5', 'value': "C"}],
+    [{'op': 'add', 'path': '/environment/Key'}]
+])
+def test_invalid_state_patch(ops):
+    state = {'environment': {'Gate': "A locked gate."}, 'random_tables': {'Names': ["A", "B"]}, 'is_action_scene': False}
+    with pytest.raises(StateUpdateError):
+        apply_state_patch(state, ops, list(state.keys()))
+
+
+# A wrong output for one state only skips that state, and the other states are still updated.
+@pytest.mark.parametrize('state_detection', ['sequential', 'batched'])
+@pytest.mark.parametrize('state_update_protocol', ['full', 'patch'])
+def test_skip_wrong_state_update(make_manager, state_detection, state_update_protocol):
+    if state_update_protocol == 'patch':
+        player_res = json.dumps([{'op': 'add', 'path': '/inventory/Key', 'value': "A rusty key."}])
+        scene_res = json.dumps([{'op': 'remove', 'path': '/environment/Door'}])
+    else:
+        player_res = json.dumps({'traits': {"Strong": "Can lift heavy things."}, 'flaws': {"Slow": "Moves slowly."}, 'inventory': {"Rope": "A long rope.", "Key": "A rusty key."}})
+        scene_res = json.dumps({'npcs': {}, 'environment': {}})
+    detect_res = ["0", "0"] if state_detection == 'sequential' else [json.dumps({'scene': True, 'players': [True]})]
+
+    manager, engine = make_manager(outputs=detect_res + [scene_res, player_res], state_detection=state_detection, state_update_protocol=state_update_protocol)
+    manager.environment = {'Gate': "A locked gate."}
+    player = make_player()
+    manager.players.append(player)
+    scene_version, player_version = manager.scene_version, player.state_version
+
+    asyncio.run(manager.update_states([ChatMessage.user(name="Player 1", content="I pick up the key next to the gate.")]))
+
+    assert manager.environment == {'Gate': "A locked gate."} and manager.scene_version == scene_version, "The wrong scene state has been applied."
+    assert player.inventory == {"Rope": "A long rope.", "Key": "A rusty key."} and player.state_version == player_version + 1, "The player state has not been updated."
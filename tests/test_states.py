@@ -0,0 +1,37 @@
+from agents.player import Player
+
+import gc
+
+
+# Making a player with the given name.
+def make_player(name: str):
+    return Player(
+        name=name, kin="Human", persona=["Brave."], goal="Escape the Labyrinth.",
+        traits={"Strong": "Can lift heavy things."}, flaws={"Slow": "Moves slowly."}, inventory={"Rope": "A long rope."}, additional_notes=[]
+    )
+
+
+# The cached prompt and snapshot are reused until the player state is changed.
+def test_reuse_player_state(make_manager):
+    manager, _ = make_manager()
+    player = make_player("Player 1")
+    manager.players.append(player)
+
+    prompt, context = manager.make_player_prompt(player), manager.make_context()
+    assert manager.make_player_prompt(player) is prompt and manager.make_context()['players'][0] is context['players'][0]
+
+    player.add_item("Key", "A rusty key.")
+    assert "Key" in manager.make_player_prompt(player).content, "The changed player state is not in the prompt."
+    assert "Key" in manager.make_context()['players'][0]['inventory'], "The changed player state is not in the context."
+    assert "Key" not in context['players'][0]['inventory'], "The previous context has been changed."
+
+
+# A new player never gets the cached states of a removed player, even if the object id is reused.
+def test_replace_player(make_manager):
+    manager, _ = make_manager()
+    for p in range(20):
+        manager.players = []
+        gc.collect()  # The id of the removed player can be reused by the next one.
+        manager.players.append(make_player(f"Player {p}"))
+        assert f"name=Player {p}," in manager.make_player_prompt(manager.players[0]).content
+        assert manager.make_context()['players'][0]['name'] == f"Player {p}"
@@ -0,0 +1,71 @@
+from conftest import play_turn
+from utils import convert_into_natural
+
+import asyncio
+import numpy as np
+import pytest
+
+
+# Checking that each message in the chat history has its own embedding at the same index.
+async def check_aligned(manager):
+    assert len(manager.chat_history) == len(manager.sent_embs), "The chat history and the embeddings have different lengths."
+    embs = await manager.embedding_cache.encode_async([convert_into_natural(message) for message in manager.chat_history])
+    scores = manager.sent_embs.buffer.similarity(embs)  # (N, N)
+    assert np.array_equal(scores.argmax(axis=1), np.arange(len(manager.chat_history))), "The embeddings are not aligned with the chat history."
+
+
+# The merged summaries should replace their children in both the chat history and the embedding index.
+@pytest.mark.parametrize('clear_raw_logs', [False, True])
+@pytest.mark.parametrize('async_summarization', [False, True])
+def test_merge_summaries(make_manager, clear_raw_logs, async_summarization):
+    manager, engine = make_manager(
+        concat_policy='retrieval', max_num_msgs=4, summarization=True, summ_period=1, summ_merge_size=2,
+        clear_raw_logs=clear_raw_logs, async_summarization=async_summarization
+    )
+
+    async def play():
+        for t in range(6):
+            await play_turn(manager, f"I try the door number {t}.")
+        await manager.splice_summary(wait=True)
+        await check_aligned(manager)
+    asyncio.run(play())
+
+    levels = [level for _, level in manager.summary_levels]
+    assert max(levels) >= 1, "No summaries have been merged."
+    for summary, _ in manager.summary_levels:
+        assert any(message is summary for message in manager.chat_history), "A summary in the levels is not in the chat history."
+    assert all(message.text != "Give me the summarization of the chat history so far." for message in manager.chat_history), "The summarization query leaked into the chat history."
+
+
+# The background summary which is still running at the end of the game is added before the event loop is closed.
+def test_finish_pending_summary(make_manager):
+    manager, engine = make_manager(summarization=True, summ_period=1, async_summarization=True)
+
+    async def play():
+        await play_turn(manager, "I open the door.")
+        assert manager.summary_task is not None, "The summarization is not running in the background."
+        await manager.finish()
+        assert len(asyncio.all_tasks() - {asyncio.current_task()}) == 0, "A background task is still pending."
+    asyncio.run(play())
+
+    assert manager.summary_task is None
+    assert manager.summary_levels[0][0] in manager.chat_history, "The last summary has not been added."
+
+
+# The failure of the background summarization is logged, and finishing the game does not raise it.
+def test_failed_background_summary(make_manager, caplog):
+    manager, engine = make_manager(summarization=True, summ_period=1, async_summarization=True)
+
+    async def fail(input_history):
+        raise ValueError("The summarizer is not available.")
+    manager.summarize_history = fail
+
+    async def play():
+        await play_turn(manager, "I open the door.")
+        await asyncio.wait([manager.summary_task[2]])
+        await asyncio.sleep(0)  # The done callbacks are called in the next iteration.
+        assert "The summarizer is not available." in caplog.text, "The failure has not been logged."
+        await manager.finish()
+    asyncio.run(play())
+
+    assert manager.summary_task is None and len(manager.summary_levels) == 0
@@ -0,0 +1,46 @@
+from kani.models import ChatMessage
+from conftest import play_turn
+
+import asyncio
+
+
+# Running one round of the game loop in main.py, which calls the manager and validates the conditions.
+# If all players time out, the manager is called without any queries.
+async def play_round(manager, engine, content: str=None) -> int:
+    if content is None:
+        async for _ in manager.full_round([], generate_states=False, include_functions=False, include_rules=False, include_scene_state=False, include_player_states=False):
+            pass
+    else:
+        await play_turn(manager, content)
+
+    num_calls = len(engine.calls)
+    await manager.validate_conditions()
+    return len(engine.calls) - num_calls
+
+
+# The conditions are validated again whenever the raw history or the conditions have changed.
+def test_skip_validation(make_manager):
+    manager, engine = make_manager()
+
+    # The number of the model calls for validating the conditions without playing any round.
+    async def validate() -> int:
+        num_calls = len(engine.calls)
+        await manager.validate_conditions()
+        return len(engine.calls) - num_calls
+
+    async def play():
+        assert await play_round(manager, engine, "I push the gate.") == 2, "The first round should be validated."
+        assert await validate() == 0, "The unchanged history should not be validated again."
+
+        # The manager's reply alone can resolve the scene.
+        assert await play_round(manager, engine) == 2, "The round without any player input but with a new reply should be validated."
+        assert await play_round(manager, engine, "I pull the gate.") == 2, "The round with a player input should be validated."
+
+        manager.success_condition = "The players climb over the gate."
+        assert await validate() == 2, "The changed condition should be validated."
+
+        # The history with the same length but a different last message is a changed one.
+        manager.raw_history = manager.raw_history[:-1] + [ChatMessage.assistant("The gate swings open.")]
+        assert await validate() == 2, "The changed last message should be validated."
+        assert await validate() == 0, "The unchanged history should not be validated again."
+    asyncio.run(play())